@@ -1,58 +1,54 @@
 import streamlit as st
-import requests
-import pickle
-import os
 from datetime import datetime
+from chat_store import HISTORY_CHAT, open_store
+from chat_ui import debug_panel, transfer_panel
+from metrics import span
+from query_client import QueryStream
 
-HISTORY_FILE = "chat_history.pkl"
+# An existing chat_history.pkl next to it is imported on first start
+HISTORY_FILE = "chat_history.db"
 
 st.set_page_config(page_title="Local Chatbot", page_icon="💬", layout="wide")
 
 # Load chat history
-if os.path.exists(HISTORY_FILE):
-    with open(HISTORY_FILE, "rb") as f:
-        chat_history = pickle.load(f)
-else:
-    chat_history = []
+with span("history_load"):
+    store = open_store(HISTORY_FILE)
+    store.ensure_chat(HISTORY_CHAT, "Chat history")
+    chat_history = store.messages(HISTORY_CHAT)
 
 # Sidebar
-with st.sidebar:
+with st.sidebar, span("sidebar"):
     st.title("💬 Local Chatbot")
     if st.button("➕ New Chat"):
-        chat_history = []
-        with open(HISTORY_FILE, "wb") as f:
-            pickle.dump(chat_history, f)
-        st.experimental_rerun()
+        store.delete_chat(HISTORY_CHAT)
+        st.rerun()
 
     st.markdown("---")
     st.markdown("### Chat History")
     for i, msg in enumerate(chat_history):
         if msg["role"] == "user":
             st.markdown(f"**You:** {msg['content'][:40]}...")
+    transfer_panel(store, HISTORY_CHAT)
+    debug_panel()
 
 st.markdown("## Talk to your AI assistant")
 
 # Chat display
-for msg in chat_history:
-    if msg["role"] == "user":
-        st.chat_message("user").markdown(msg["content"])
-    else:
-        st.chat_message("assistant").markdown(msg["content"])
+with span("messages"):
+    for msg in chat_history:
+        if msg["role"] == "user":
+            st.chat_message("user").markdown(msg["content"])
+        else:
+            st.chat_message("assistant").markdown(msg["content"])
 
 # User input
 if prompt := st.chat_input("Ask something..."):
     st.chat_message("user").markdown(prompt)
-    chat_history.append({"role": "user", "content": prompt})
-
-    # Send request
-    try:
-        res = requests.post("http://localhost:5002/query", json={"query": prompt})
-        answer = res.json().get("response", "No response from server.")
-    except Exception as e:
-        answer = f"Error contacting server: {e}"
-
-    st.chat_message("assistant").markdown(answer)
-    chat_history.append({"role": "assistant", "content": answer})
-
-    with open(HISTORY_FILE, "wb") as f:
-        pickle.dump(chat_history, f)
+    store.append_message(HISTORY_CHAT, {"role": "user", "content": prompt})
+
+    # Send request, rendering tokens as they arrive
+    reply = QueryStream(prompt)
+    st.chat_message("assistant").write_stream(reply)
+    answer = reply.answer
+    with span("history_save"):
+        store.append_message(HISTORY_CHAT, {"role": "assistant", "content": answer})
@@ -1,69 +1,61 @@
 import streamlit as st
-import pickle
-import os
 from datetime import datetime
-from uuid import uuid4
-import requests
-
-DATA_FILE = "conversations.pkl"
+from chat_store import open_store
+from chat_ui import (
+    config_answer,
+    debug_panel,
+    decoded,
+    inject_theme,
+    is_long,
+    job_panel,
+    message_window,
+    refresh_messages,
+    rerun_fragment,
+    search_panel,
+    similar_offer,
+    transfer_panel,
+)
+from job_queue import shared_jobs
+from metrics import traced
+from query_client import POLL_INTERVAL, poll_pending, shared_cache, suggest_similar
+
+DATA_FILE = "conversations.db"
 
 st.set_page_config(page_title="GenAI Config Generator", page_icon="🧰", layout="wide")
 
-st.markdown("""
-    <style>
-        .stChatMessage { margin-bottom: 1rem; }
-        .user-bubble, .assistant-bubble {
-            background: var(--primary-color);
-            color: white;
-            padding: 1rem;
-            border-radius: 1rem;
-            display: inline-block;
-            max-width: 85%;
-        }
-        .edit-btn, .del-btn {
-            cursor: pointer;
-            font-size: 0.8rem;
-            margin-left: 0.4rem;
-            color: #999;
-        }
-        .edit-btn:hover, .del-btn:hover {
-            color: #f33;
-        }
-        .sample-queries {
-            margin-top: 2rem;
-            font-style: italic;
-            color: #aaa;
-        }
-    </style>
-""", unsafe_allow_html=True)
+inject_theme("config")
 
 # Load or initialize data
-if os.path.exists(DATA_FILE):
-    with open(DATA_FILE, "rb") as f:
-        conversations = pickle.load(f)
-else:
-    conversations = {}
+store = open_store(DATA_FILE)
+conversations = store.chats
+# Configs are generated as durable background jobs, resumed after a restart
+jobs = shared_jobs(DATA_FILE)
 
-if "active_chat_id" not in st.session_state:
+if st.session_state.get("active_chat_id") not in conversations:
     st.session_state.active_chat_id = list(conversations.keys())[0] if conversations else None
-if "edit_index" not in st.session_state:
-    st.session_state.edit_index = None
+if "edit_id" not in st.session_state:
+    st.session_state.edit_id = None
 
 # Create a new chat
 def create_new_chat(name=None):
-    chat_id = str(uuid4())
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
     chat_name = name if name else f"Config @ {timestamp}"
-    conversations[chat_id] = {"name": chat_name, "messages": []}
+    chat_id = store.create_chat(chat_name)
     st.session_state.active_chat_id = chat_id
-    save_conversations()
 
-def save_conversations():
-    with open(DATA_FILE, "wb") as f:
-        pickle.dump(conversations, f)
+# Per-message actions run as callbacks, so a click only reruns the message fragment
+def start_edit(msg_id):
+    st.session_state.edit_id = msg_id
+
+def delete_message(chat_id, msg_id):
+    store.delete_message(chat_id, msg_id)
+    if st.session_state.edit_id == msg_id:
+        st.session_state.edit_id = None
 
 # Sidebar
-with st.sidebar:
+@st.fragment
+@traced("sidebar")
+def chat_list():
     st.title("🧰 GenAI Config Generator")
     new_chat_name = st.text_input("New Config Name", "")
     if st.button("➕ New Config"):
@@ -73,23 +65,33 @@ with st.sidebar:
     st.markdown("---")
     st.subheader("Saved Configs")
     to_delete = None
-    for cid, chat in conversations.items():
+    for cid, chat in store.chats.items():
         cols = st.columns([8, 1, 1])
         with cols[0]:
             if st.button(f"{chat['name']}", key=f"chat_{cid}"):
                 st.session_state.active_chat_id = cid
-                st.session_state.edit_index = None
+                st.session_state.edit_id = None
                 st.rerun()
         with cols[1]:
             st.markdown("<span class='edit-btn'>✏</span>", unsafe_allow_html=True)
         with cols[2]:
             if st.button("❌", key=f"del_{cid}"):
                 to_delete = cid
+
     if to_delete:
-        del conversations[to_delete]
-        st.session_state.active_chat_id = list(conversations.keys())[0] if conversations else None
-        save_conversations()
-        st.rerun()
+        store.delete_chat(to_delete)
+        if st.session_state.active_chat_id == to_delete:
+            st.session_state.active_chat_id = next(iter(store.chats), None)
+            st.rerun()
+        rerun_fragment()
+
+with st.sidebar:
+    chat_list()
+    search_panel(store)
+    transfer_panel(store)
+    st.caption(store.describe_usage())
+    st.caption(shared_cache().describe())
+    debug_panel()
 
 # Chat Display
 st.title("Generate Configuration")
@@ -105,47 +107,87 @@ if not chat_id:
     """, unsafe_allow_html=True)
     st.stop()
 
-messages = conversations[chat_id]["messages"]
-
-for i, msg in enumerate(messages):
-    col1, col2 = st.columns([12, 1])
-    with col1:
-        if msg["role"] == "user":
-            if st.session_state.edit_index == i:
-                new_text = st.text_area("Edit your input:", value=msg["content"], key=f"edit_{i}")
-                if st.button("Update", key=f"resend_{i}"):
-                    messages[i]["content"] = new_text
-                    if i+1 < len(messages) and messages[i+1]["role"] == "assistant":
-                        del messages[i+1]
-                    requests.post("http://localhost:5002/query", json={"query": new_text})
-                    messages.insert(i+1, {"role": "assistant", "content": "Response saved."})
-                    st.session_state.edit_index = None
-                    save_conversations()
-                    st.rerun()
+messages = store.messages(chat_id)
+# Configs still being generated in the background are picked up by polling the message fragment
+polling = poll_pending(store, chat_id)
+
+@st.fragment(run_every=POLL_INTERVAL if polling else None)
+@traced("messages")
+def chat_messages():
+    messages = refresh_messages(store, chat_id, polling)
+    job_panel(jobs, chat_id)
+
+    # Render only the newest page of messages
+    start = message_window(messages, chat_id)
+    contents = {}
+    for i, msg in enumerate(messages[start:], start):
+        msg_id = msg["id"]
+        col1, col2 = st.columns([12, 1])
+        with col1:
+            if msg["role"] == "user":
+                if st.session_state.edit_id == msg_id:
+                    new_text = st.text_area("Edit your input:", value=msg["content"], key=f"edit_{msg_id}")
+                    if st.button("Update", key=f"resend_{msg_id}"):
+                        store.edit_message(chat_id, msg_id, new_text)
+                        if i+1 < len(messages) and messages[i+1]["role"] == "assistant":
+                            store.delete_message(chat_id, messages[i+1]["id"])
+                        jobs.submit(chat_id, [new_text], after=msg_id)
+                        st.session_state.edit_id = None
+                        st.rerun()
+                else:
+                    st.markdown(f'<div class="user-bubble">{msg["content"]}</div>', unsafe_allow_html=True)
             else:
-                st.markdown(f'<div class="user-bubble">{msg["content"]}</div>', unsafe_allow_html=True)
-        else:
-            st.markdown(f'<div class="assistant-bubble">{msg["content"]}</div>', unsafe_allow_html=True)
-
-    with col2:
-        if msg["role"] == "user":
-            if st.button("✏", key=f"editbtn_{i}"):
-                st.session_state.edit_index = i
-                st.rerun()
-        if st.button("🗑", key=f"delbtn_{i}"):
-            del messages[i]
-            if st.session_state.edit_index == i:
-                st.session_state.edit_index = None
-            save_conversations()
-            st.rerun()
+                content = decoded(msg, contents)
+                if is_long(content) and "pending" not in msg:
+                    config_answer(messages, i, contents, '<div class="assistant-bubble">{}</div>')
+                else:
+                    st.markdown(f'<div class="assistant-bubble">{content}</div>', unsafe_allow_html=True)
+
+        with col2:
+            if msg["role"] == "user":
+                st.button("✏", key=f"editbtn_{msg_id}", on_click=start_edit, args=(msg_id,))
+            st.button("🗑", key=f"delbtn_{msg_id}", on_click=delete_message, args=(chat_id, msg_id))
+
+chat_messages()
 
 # User Input
-user_input = st.text_area("Enter your config request:", key="main_input")
-if st.button("Submit") and user_input.strip():
-    messages.append({"role": "user", "content": user_input.strip()})
-    requests.post("http://localhost:5002/query", json={"query": user_input.strip()})
-    messages.append({"role": "assistant", "content": "Response saved."})
-    save_conversations()
-    st.rerun()
+@st.fragment
+@traced("input")
+def config_input():
+    user_input = st.text_area("Enter your config request:", key="main_input")
+    if st.button("Submit") and user_input.strip():
+        prompt = user_input.strip()
+        # A near-duplicate of an earlier request is offered before regenerating
+        match = suggest_similar(prompt)
+        if match is None:
+            jobs.submit(chat_id, [prompt])
+            st.rerun()
+        st.session_state.similar = (chat_id, prompt, match)
+
+    offer = st.session_state.get("similar")
+    if offer and offer[0] == chat_id:
+        choice = similar_offer(offer[1], offer[2])
+        if choice == "use":
+            store.append_message(chat_id, {"role": "user", "content": offer[1]})
+            store.append_message(chat_id, {"role": "assistant", "content": offer[2][2]})
+        elif choice == "ask":
+            jobs.submit(chat_id, [offer[1]])
+        if choice:
+            del st.session_state.similar
+            st.rerun()
+
+    # One request per node, all queued at once
+    with st.expander("📦 Batch submit"):
+        template = st.text_input(
+            "Request ({node} is replaced)", "Generate config for RAN node {node}", key="batch_template"
+        )
+        lines = st.text_area("Nodes, one per line", key="batch_nodes").splitlines()
+        nodes = [line.strip() for line in lines if line.strip()]
+        if st.button(f"Submit {len(nodes)} requests", key="batch_submit", disabled=not nodes):
+            # Prompts differ only in the node, so never serve one node's config for another
+            jobs.submit(chat_id, [template.replace("{node}", node) for node in nodes], serve_similar=False)
+            st.rerun()
+
+config_input()
 
 
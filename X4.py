@@ -1,79 +1,55 @@
 import streamlit as st
-import requests
-import pickle
-import os
 from datetime import datetime
-from uuid import uuid4
+from chat_store import open_store
+from chat_ui import (
+    debug_panel,
+    inject_theme,
+    message_window,
+    refresh_messages,
+    regenerate_panel,
+    rerun_fragment,
+    search_panel,
+    transfer_panel,
+)
+from metrics import traced
+from query_client import POLL_INTERVAL, dispatch_query, poll_pending, shared_cache
 
-DATA_FILE = "conversations.pkl"
+DATA_FILE = "conversations.db"
 
 st.set_page_config(page_title="Gradient Chatbot", page_icon="🌟", layout="wide")
 
 # Force dark mode via custom CSS
-st.markdown("""
-    <style>
-        html, body, [class*="css"] {
-            background-color: #121212 !important;
-            color: #e0e0e0 !important;
-        }
-        .stChatMessage { margin-bottom: 1rem; }
-        .user-bubble {
-            background: linear-gradient(135deg, #667eea, #764ba2);
-            color: white;
-            padding: 1rem;
-            border-radius: 1rem;
-            display: inline-block;
-            max-width: 85%;
-        }
-        .assistant-bubble {
-            background: linear-gradient(135deg, #43cea2, #185a9d);
-            color: white;
-            padding: 1rem;
-            border-radius: 1rem;
-            display: inline-block;
-            max-width: 85%;
-        }
-        .icon-btn {
-            font-size: 0.8rem;
-            padding: 0.2rem;
-        }
-        .sample-query {
-            background: #2c2c2c;
-            padding: 0.6rem 1rem;
-            border-radius: 0.5rem;
-            margin-bottom: 0.5rem;
-            display: inline-block;
-        }
-    </style>
-""", unsafe_allow_html=True)
+inject_theme("gradient_dark")
 
 # Load or initialize data
-if os.path.exists(DATA_FILE):
-    with open(DATA_FILE, "rb") as f:
-        conversations = pickle.load(f)
-else:
-    conversations = {}
+store = open_store(DATA_FILE)
+conversations = store.chats
 
-if "active_chat_id" not in st.session_state:
+if st.session_state.get("active_chat_id") not in conversations:
     st.session_state.active_chat_id = list(conversations.keys())[0] if conversations else None
-if "edit_index" not in st.session_state:
-    st.session_state.edit_index = None
+if "edit_id" not in st.session_state:
+    st.session_state.edit_id = None
 
 # Create a new chat
 def create_new_chat(name=None):
-    chat_id = str(uuid4())
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
     chat_name = name if name else f"Chat @ {timestamp}"
-    conversations[chat_id] = {"name": chat_name, "messages": []}
+    chat_id = store.create_chat(chat_name)
     st.session_state.active_chat_id = chat_id
-    save_conversations()
 
-def save_conversations():
-    with open(DATA_FILE, "wb") as f:
-        pickle.dump(conversations, f)
+# Per-message actions run as callbacks, so a click only reruns the message fragment
+def start_edit(msg_id):
+    st.session_state.edit_id = msg_id
+
+def delete_message(chat_id, msg_id):
+    store.delete_message(chat_id, msg_id)
+    if st.session_state.edit_id == msg_id:
+        st.session_state.edit_id = None
 
 # Sidebar
-with st.sidebar:
+@st.fragment
+@traced("sidebar")
+def chat_list():
     st.title("🌟 Gradient Chatbot")
     new_chat_name = st.text_input("New Chat Name", "")
     if st.button("➕ New Chat"):
@@ -83,28 +59,39 @@ with st.sidebar:
     st.markdown("---")
     st.subheader("Conversations")
     to_delete = None
-    for cid, chat in conversations.items():
+    for cid, chat in store.chats.items():
         cols = st.columns([8, 1, 1])
         with cols[0]:
             if st.button(f"📂 {chat['name']}", key=f"chat_{cid}"):
                 st.session_state.active_chat_id = cid
-                st.session_state.edit_index = None
+                st.session_state.edit_id = None
                 st.rerun()
         with cols[1]:
             if st.button("🖉", key=f"edit_chat_{cid}", help="Rename"):
                 new_name = st.text_input("Rename Chat", value=chat["name"], key=f"name_{cid}")
                 if new_name:
-                    chat["name"] = new_name
-                    save_conversations()
-                    st.rerun()
+                    store.rename_chat(cid, new_name)
+                    rerun_fragment()
         with cols[2]:
             if st.button("🗑️", key=f"del_{cid}", help="Delete"):
                 to_delete = cid
+
     if to_delete:
-        del conversations[to_delete]
-        st.session_state.active_chat_id = list(conversations.keys())[0] if conversations else None
-        save_conversations()
-        st.rerun()
+        store.delete_chat(to_delete)
+        if st.session_state.active_chat_id == to_delete:
+            st.session_state.active_chat_id = next(iter(store.chats), None)
+            st.rerun()
+        rerun_fragment()
+
+with st.sidebar:
+    chat_list()
+    search_panel(store)
+    transfer_panel(store)
+    regenerate_panel(store)
+    st.caption(store.describe_usage())
+    st.caption(shared_cache().describe())
+    bypass_cache = st.checkbox("Bypass response cache", help="Always ask the backend, even for repeated questions")
+    debug_panel()
 
 # Main Chat UI
 st.title("Talk to Your Assistant")
@@ -122,64 +109,51 @@ if not chat_id:
     for q in sample_queries:
         if st.button(q, key=q):
             create_new_chat()
-            st.session_state.active_chat_id = list(conversations.keys())[-1]
-            conversations[st.session_state.active_chat_id]["messages"].append({"role": "user", "content": q})
-            try:
-                res = requests.post("http://localhost:5002/query", json={"query": q})
-                answer = res.json().get("response", "No response from server.")
-            except Exception as e:
-                answer = f"Error: {e}"
-            conversations[st.session_state.active_chat_id]["messages"].append({"role": "assistant", "content": answer})
-            save_conversations()
+            st.session_state.active_chat_id = list(store.chats.keys())[-1]
+            store.append_message(st.session_state.active_chat_id, {"role": "user", "content": q})
+            dispatch_query(store, st.session_state.active_chat_id, q, error_prefix="Error", use_cache=not bypass_cache)
             st.rerun()
     st.stop()
 
-messages = conversations[chat_id]["messages"]
-
-for i, msg in enumerate(messages):
-    col1, col2 = st.columns([12, 1])
-    with col1:
-        if msg["role"] == "user":
-            if st.session_state.edit_index == i:
-                new_text = st.text_area("Edit message:", value=msg["content"], key=f"edit_{i}")
-                if st.button("🔄 Resend", key=f"resend_{i}"):
-                    messages[i]["content"] = new_text
-                    if i+1 < len(messages) and messages[i+1]["role"] == "assistant":
-                        del messages[i+1]
-                    try:
-                        res = requests.post("http://localhost:5002/query", json={"query": new_text})
-                        answer = res.json().get("response", "No response from server.")
-                    except Exception as e:
-                        answer = f"Error: {e}"
-                    messages.insert(i+1, {"role": "assistant", "content": answer})
-                    st.session_state.edit_index = None
-                    save_conversations()
-                    st.rerun()
+messages = store.messages(chat_id)
+# Replies still being computed in the background are picked up by polling the message fragment
+polling = poll_pending(store, chat_id)
+
+@st.fragment(run_every=POLL_INTERVAL if polling else None)
+@traced("messages")
+def chat_messages():
+    messages = refresh_messages(store, chat_id, polling)
+
+    # Render only the newest page of messages
+    start = message_window(messages, chat_id)
+    for i, msg in enumerate(messages[start:], start):
+        msg_id = msg["id"]
+        col1, col2 = st.columns([12, 1])
+        with col1:
+            if msg["role"] == "user":
+                if st.session_state.edit_id == msg_id:
+                    new_text = st.text_area("Edit message:", value=msg["content"], key=f"edit_{msg_id}")
+                    if st.button("🔄 Resend", key=f"resend_{msg_id}"):
+                        store.edit_message(chat_id, msg_id, new_text)
+                        if i+1 < len(messages) and messages[i+1]["role"] == "assistant":
+                            store.delete_message(chat_id, messages[i+1]["id"])
+                        dispatch_query(store, chat_id, new_text, after=msg_id, error_prefix="Error", use_cache=not bypass_cache)
+                        st.session_state.edit_id = None
+                        st.rerun()
+                else:
+                    st.markdown(f'<div class="user-bubble">🧑‍💬 {msg["content"]}</div>', unsafe_allow_html=True)
             else:
-                st.markdown(f'<div class="user-bubble">🧑‍💬 {msg["content"]}</div>', unsafe_allow_html=True)
-        else:
-            st.markdown(f'<div class="assistant-bubble">🤖 {msg["content"]}</div>', unsafe_allow_html=True)
-
-    with col2:
-        if msg["role"] == "user":
-            if st.button("🖉", key=f"editbtn_{i}", help="Edit", use_container_width=True):
-                st.session_state.edit_index = i
-                st.rerun()
-        if st.button("🗑️", key=f"delbtn_{i}", help="Delete", use_container_width=True):
-            del messages[i]
-            if st.session_state.edit_index == i:
-                st.session_state.edit_index = None
-            save_conversations()
-            st.rerun()
+                st.markdown(f'<div class="assistant-bubble">🤖 {msg["content"]}</div>', unsafe_allow_html=True)
+
+        with col2:
+            if msg["role"] == "user":
+                st.button("🖉", key=f"editbtn_{msg_id}", help="Edit", use_container_width=True, on_click=start_edit, args=(msg_id,))
+            st.button("🗑️", key=f"delbtn_{msg_id}", help="Delete", use_container_width=True, on_click=delete_message, args=(chat_id, msg_id))
+
+chat_messages()
 
 # Input Box
 if prompt := st.chat_input("Ask something..."):
-    messages.append({"role": "user", "content": prompt})
-    try:
-        res = requests.post("http://localhost:5002/query", json={"query": prompt})
-        answer = res.json().get("response", "No response from server.")
-    except Exception as e:
-        answer = f"Error contacting server: {e}"
-    messages.append({"role": "assistant", "content": answer})
-    save_conversations()
+    store.append_message(chat_id, {"role": "user", "content": prompt})
+    dispatch_query(store, chat_id, prompt, use_cache=not bypass_cache)
     st.rerun()
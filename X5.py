@@ -1,67 +1,55 @@
 import streamlit as st
-import requests
-import pickle
-import os
 from datetime import datetime
-from uuid import uuid4
-
-DATA_FILE = "conversations.pkl"
+from chat_store import open_store
+from chat_ui import (
+    debug_panel,
+    inject_theme,
+    message_window,
+    refresh_messages,
+    regenerate_panel,
+    rerun_fragment,
+    search_panel,
+    transfer_panel,
+)
+from metrics import traced
+from query_client import POLL_INTERVAL, dispatch_query, poll_pending, shared_cache
+
+DATA_FILE = "conversations.db"
 
 st.set_page_config(page_title="Gradient Chatbot", page_icon="🌟", layout="wide")
 
 # Apply dark mode
-st.markdown("""
-    <style>
-        html, body, [class*="st-"] {
-            background-color: #1e1e1e;
-            color: white;
-        }
-        .chat-bubble {
-            background-color: #333333;
-            padding: 1rem;
-            border-radius: 0.75rem;
-            margin-bottom: 0.5rem;
-            display: inline-block;
-            max-width: 85%;
-        }
-        .chat-avatar {
-            margin-right: 0.5rem;
-        }
-        .icon-button {
-            font-size: 0.75rem !important;
-            padding: 0.2rem 0.4rem !important;
-            margin-left: 0.2rem;
-        }
-    </style>
-""", unsafe_allow_html=True)
+inject_theme("dark")
 
 # Load or initialize data
-if os.path.exists(DATA_FILE):
-    with open(DATA_FILE, "rb") as f:
-        conversations = pickle.load(f)
-else:
-    conversations = {}
+store = open_store(DATA_FILE)
+conversations = store.chats
 
-if "active_chat_id" not in st.session_state:
+if st.session_state.get("active_chat_id") not in conversations:
     st.session_state.active_chat_id = list(conversations.keys())[0] if conversations else None
-if "edit_index" not in st.session_state:
-    st.session_state.edit_index = None
+if "edit_id" not in st.session_state:
+    st.session_state.edit_id = None
 
 # Functions
-def save_conversations():
-    with open(DATA_FILE, "wb") as f:
-        pickle.dump(conversations, f)
-
 def create_new_chat(name=None):
-    chat_id = str(uuid4())
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
     chat_name = name if name else f"Chat @ {timestamp}"
-    conversations[chat_id] = {"name": chat_name, "messages": []}
+    chat_id = store.create_chat(chat_name)
     st.session_state.active_chat_id = chat_id
-    save_conversations()
+
+# Per-message actions run as callbacks, so a click only reruns the message fragment
+def start_edit(msg_id):
+    st.session_state.edit_id = msg_id
+
+def delete_message(chat_id, msg_id):
+    store.delete_message(chat_id, msg_id)
+    if st.session_state.edit_id == msg_id:
+        st.session_state.edit_id = None
 
 # Sidebar
-with st.sidebar:
+@st.fragment
+@traced("sidebar")
+def chat_list():
     st.title("🌟 Gradient Chatbot")
 
     new_chat_name = st.text_input("New Chat Name", "")
@@ -72,22 +60,33 @@ with st.sidebar:
     st.markdown("---")
     st.subheader("Conversations")
     to_delete = None
-    for cid, chat in conversations.items():
+    for cid, chat in store.chats.items():
         col1, col2 = st.columns([8, 2])
         with col1:
             if st.button(chat["name"], key=f"chat_{cid}"):
                 st.session_state.active_chat_id = cid
-                st.session_state.edit_index = None
+                st.session_state.edit_id = None
                 st.rerun()
         with col2:
             if st.button("🗑️", key=f"del_{cid}", help="Delete"):
                 to_delete = cid
 
     if to_delete:
-        del conversations[to_delete]
-        st.session_state.active_chat_id = list(conversations.keys())[0] if conversations else None
-        save_conversations()
-        st.rerun()
+        store.delete_chat(to_delete)
+        if st.session_state.active_chat_id == to_delete:
+            st.session_state.active_chat_id = next(iter(store.chats), None)
+            st.rerun()
+        rerun_fragment()
+
+with st.sidebar:
+    chat_list()
+    search_panel(store)
+    transfer_panel(store)
+    regenerate_panel(store)
+    st.caption(store.describe_usage())
+    st.caption(shared_cache().describe())
+    bypass_cache = st.checkbox("Bypass response cache", help="Always ask the backend, even for repeated questions")
+    debug_panel()
 
 # Chat display
 st.title("Talk to Your Assistant")
@@ -102,67 +101,54 @@ if not chat_id:
     st.markdown("- Generate a poem about the moon.")
     st.stop()
 
-messages = conversations[chat_id]["messages"]
-
-for i, msg in enumerate(messages):
-    col1, col2 = st.columns([12, 1])
-    with col1:
-        if msg["role"] == "user":
-            if st.session_state.edit_index == i:
-                new_text = st.text_area("Edit message:", value=msg["content"], key=f"edit_{i}")
-                if st.button("Resend", key=f"resend_{i}"):
-                    messages[i]["content"] = new_text
-
-                    # Update chat name if it's the first message
-                    if i == 0:
-                        conversations[chat_id]["name"] = new_text[:30] + "..." if len(new_text) > 30 else new_text
-
-                    # Remove assistant message after it
-                    if i + 1 < len(messages) and messages[i + 1]["role"] == "assistant":
-                        del messages[i + 1]
-                    try:
-                        res = requests.post("http://localhost:5002/query", json={"query": new_text})
-                        answer = res.json().get("response", "No response from server.")
-                    except Exception as e:
-                        answer = f"Error: {e}"
-                    messages.insert(i + 1, {"role": "assistant", "content": answer})
-                    st.session_state.edit_index = None
-                    save_conversations()
-                    st.rerun()
-            else:
-                st.markdown(f'<div class="chat-bubble"><strong>🧑‍💬</strong> {msg["content"]}</div>', unsafe_allow_html=True)
-        else:
-            st.markdown(f'<div class="chat-bubble"><strong>🤖</strong> {msg["content"]}</div>', unsafe_allow_html=True)
-
-    with col2:
-        if msg["role"] == "user":
-            if st.button("✏️", key=f"editbtn_{i}", help="Edit", use_container_width=True):
-                st.session_state.edit_index = i
-                st.rerun()
-        if st.button("🗑️", key=f"delbtn_{i}", help="Delete", use_container_width=True):
-            del messages[i]
-            if st.session_state.edit_index == i:
-                st.session_state.edit_index = None
-            save_conversations()
-            st.rerun()
+# Replies still being computed in the background are picked up by polling the message fragment
+polling = poll_pending(store, chat_id)
 
-# Chat Input
-if prompt := st.chat_input("Ask something..."):
-    messages.append({"role": "user", "content": prompt})
-    if len(messages) == 1:
-        conversations[chat_id]["name"] = prompt[:30] + "..." if len(prompt) > 30 else prompt
+@st.fragment(run_every=POLL_INTERVAL if polling else None)
+@traced("messages")
+def chat_messages():
+    messages = refresh_messages(store, chat_id, polling)
+
+    # Render only the newest page of messages
+    start = message_window(messages, chat_id)
+    for i, msg in enumerate(messages[start:], start):
+        msg_id = msg["id"]
+        col1, col2 = st.columns([12, 1])
+        with col1:
+            if msg["role"] == "user":
+                if st.session_state.edit_id == msg_id:
+                    new_text = st.text_area("Edit message:", value=msg["content"], key=f"edit_{msg_id}")
+                    if st.button("Resend", key=f"resend_{msg_id}"):
+                        store.edit_message(chat_id, msg_id, new_text)
+
+                        # Update chat name if it's the first message
+                        if i == 0:
+                            store.rename_chat(chat_id, new_text[:30] + "..." if len(new_text) > 30 else new_text)
+
+                        # Remove assistant message after it
+                        if i + 1 < len(messages) and messages[i + 1]["role"] == "assistant":
+                            store.delete_message(chat_id, messages[i + 1]["id"])
+                        dispatch_query(store, chat_id, new_text, after=msg_id, error_prefix="Error", use_cache=not bypass_cache)
+                        st.session_state.edit_id = None
+                        st.rerun()
+                else:
+                    st.markdown(f'<div class="chat-bubble"><strong>🧑‍💬</strong> {msg["content"]}</div>', unsafe_allow_html=True)
+            else:
+                st.markdown(f'<div class="chat-bubble"><strong>🤖</strong> {msg["content"]}</div>', unsafe_allow_html=True)
 
-    with st.chat_message("user", avatar="🧍"):
-        st.markdown(prompt)
+        with col2:
+            if msg["role"] == "user":
+                st.button("✏️", key=f"editbtn_{msg_id}", help="Edit", use_container_width=True, on_click=start_edit, args=(msg_id,))
+            st.button("🗑️", key=f"delbtn_{msg_id}", help="Delete", use_container_width=True, on_click=delete_message, args=(chat_id, msg_id))
 
-    try:
-        res = requests.post("http://localhost:5002/query", json={"query": prompt})
-        answer = res.json().get("response", "No response from server.")
-    except Exception as e:
-        answer = f"Error contacting server: {e}"
+chat_messages()
 
-    messages.append({"role": "assistant", "content": answer})
-    with st.chat_message("assistant", avatar="🤖"):
-        st.markdown(answer)
+# Chat Input
+if prompt := st.chat_input("Ask something..."):
+    # Named after its first message, going by the store rather than the list
+    # rendered above, which may be stale by now
+    if store.append_message(chat_id, {"role": "user", "content": prompt}) == 0:
+        store.rename_chat(chat_id, prompt[:30] + "..." if len(prompt) > 30 else prompt)
 
-    save_conversations()
+    dispatch_query(store, chat_id, prompt, use_cache=not bypass_cache)
+    st.rerun()
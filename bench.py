@@ -0,0 +1,261 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+import fake_backend
+from chat_store import HISTORY_CHAT, ChatStore, new_id, now, shared_store
+from job_queue import shared_jobs
+from query_client import shared_dispatcher
+
+# Rerun benchmark for every frontend over a synthetic history.
+#
+#   python bench.py --chats 20 --messages 200 --length 400 --repeat 3 --output bench_output.txt
+#
+# Each frontend is driven through AppTest against a fresh store and
+# fake_backend on ports 5000 and 5002. One JSON object per line is written
+# for every (frontend, interaction): wall time per rerun and peak Python
+# heap (tracemalloc), plus a "storage" line with cold load / save times
+# and the size of the database on disk.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FRONTENDS = ["X.py", "X2.py", "X3.py", "X4.py", "X5.py", "x5,py"]
+WORDS = "config model layer batch token learning rate optimizer gradient dataset shard replica cache".split()
+
+
+def text(rng, length):
+    words = []
+    while sum(len(w) + 1 for w in words) < length:
+        words.append(rng.choice(WORDS))
+    return " ".join(words)[:length]
+
+
+def synthetic_messages(rng, count, length):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": text(rng, length), "timestamp": now()}
+        for i in range(count)
+    ]
+
+
+def database(frontend):
+    # X.py keeps its single conversation in its own file
+    return "chat_history.db" if frontend == "X.py" else "conversations.db"
+
+
+def build_store(frontend, chats, messages, length, seed):
+    # Synthetic history in one bulk transaction; X.py gets one conversation
+    rng = random.Random(seed)
+    store = ChatStore(database(frontend))
+    if frontend == "X.py":
+        names = {HISTORY_CHAT: "Chat history"}
+    else:
+        names = {new_id(): f"Chat {n}" for n in range(chats)}
+
+    def _fill():
+        for cid, name in names.items():
+            store._insert_chat(cid, name, now(), now())
+            for pos, msg in enumerate(synthetic_messages(rng, messages, length)):
+                store._insert_message(cid, pos, msg)
+
+    store.write(_fill)
+    store.compact()
+    store.conn.close()
+
+
+def storage_times(frontend):
+    # Cold load of what the first rerun needs, one saved message, and the
+    # database size in bytes
+    path = database(frontend)
+    size = os.path.getsize(path)
+    start = time.perf_counter()
+    store = ChatStore(path)
+    cid = next(iter(store.chats))
+    store.messages(cid)
+    loaded = time.perf_counter()
+    msg = {"role": "user", "content": "bench"}
+    store.append_message(cid, msg)
+    saved = time.perf_counter()
+    store.delete_message(cid, msg["id"])
+    store.conn.close()
+    return loaded - start, saved - loaded, size
+
+
+def script_path(frontend, workdir):
+    # AppTest wants a .py file name, x5,py does not have one
+    if frontend.endswith(".py"):
+        return os.path.join(HERE, frontend)
+    path = os.path.join(workdir, frontend.replace(",", "_") + ".py")
+    shutil.copy(os.path.join(HERE, frontend), path)
+    return path
+
+
+def wait_idle(frontend, timeout=60):
+    # Let background replies land before the next measurement; X3.py's
+    # run as durable jobs rather than on the dispatcher
+    deadline = time.monotonic() + timeout
+    dispatcher = shared_dispatcher()
+    jobs = shared_jobs(database(frontend)) if frontend == "X3.py" else None
+    while (dispatcher.jobs or (jobs is not None and jobs.busy())) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def measure(fn, memory):
+    # (fn's result, wall seconds, peak traced bytes or None)
+    if memory:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    result = fn()
+    wall = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if memory else None
+    return result, wall, peak
+
+
+def find(elements, prefix):
+    return [e for e in elements if (e.key or "").startswith(prefix)]
+
+
+def interactions(frontend, at, seq):
+    # (name, action) pairs in order; actions return False when the
+    # frontend has no such interaction
+    def first_load():
+        at.run()
+
+    def send():
+        prompt = f"benchmark question {seq}"
+        if at.chat_input:
+            at.chat_input[0].set_value(prompt).run()
+        else:
+            at.text_area(key="main_input").set_value(prompt)
+            [b for b in at.button if b.label == "Submit"][0].click().run()
+
+    def edit():
+        if frontend == "x5,py":
+            # The edit button there is HTML posting edit_msg_id from JS
+            messages = shared_store("conversations.db").messages(at.session_state.active_chat_id)
+            at.session_state.edit_msg_id = [m for m in messages if m["role"] == "user"][-1]["id"]
+            at.run()
+        else:
+            buttons = find(at.button, "editbtn_")
+            if not buttons:
+                return False
+            buttons[-1].click().run()
+        find(at.text_area, "edit_")[0].set_value(f"edited question {seq}")
+        (find(at.button, "resend_") + find(at.button, "save_"))[0].click().run()
+
+    def delete():
+        buttons = find(at.button, "delbtn_")
+        if not buttons:
+            return False
+        buttons[-1].click().run()
+
+    def switch():
+        buttons = find(at.sidebar.button, "chat_")
+        if len(buttons) < 2:
+            return False
+        buttons[1].click().run()
+
+    yield "first_load", first_load
+    yield "send", send
+    if frontend != "X.py":
+        yield "edit", edit
+        yield "delete", delete
+        yield "switch", switch
+
+
+def run_frontend(frontend, args, workdir, repeat):
+    for name in os.listdir(workdir):
+        if name.startswith(("conversations.", "chat_history.")):
+            os.remove(os.path.join(workdir, name))
+    # Cold start: no cached store, client, response cache or dispatcher
+    st.cache_resource.clear()
+    build_store(frontend, args.chats, args.messages, args.length, args.seed)
+    results = {"storage": storage_times(frontend)}
+
+    at = AppTest.from_file(script_path(frontend, workdir), default_timeout=args.timeout)
+    for name, action in interactions(frontend, at, repeat):
+        skipped, wall, peak = measure(action, args.memory)
+        if skipped is False:
+            continue
+        if at.exception:
+            raise RuntimeError(f"{frontend} {name}: {at.exception[0].value}")
+        results[name] = (wall, peak)
+        wait_idle(frontend)
+    return results
+
+
+def summarize(frontend, interaction, samples, args):
+    record = {
+        "frontend": frontend,
+        "interaction": interaction,
+        "chats": args.chats,
+        "messages": args.messages,
+        "length": args.length,
+        "runs": len(samples),
+    }
+    if interaction == "storage":
+        record["kind"] = "sqlite"
+        record["load_median_s"] = statistics.median(s[0] for s in samples)
+        record["save_median_s"] = statistics.median(s[1] for s in samples)
+        record["disk_bytes"] = samples[0][2]
+        return record
+    walls = [s[0] for s in samples]
+    record.update(median_s=statistics.median(walls), min_s=min(walls), max_s=max(walls))
+    if samples[0][1] is not None:
+        record["peak_bytes"] = max(s[1] for s in samples)
+    return record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-rerun benchmark of the chat frontends")
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=100, help="messages per chat")
+    parser.add_argument("--length", type=int, default=300, help="characters per message")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--frontends", nargs="+", default=FRONTENDS, choices=FRONTENDS)
+    parser.add_argument("--timeout", type=float, default=60.0, help="AppTest timeout per rerun")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip tracemalloc")
+    parser.add_argument("--output", help="also append the JSON lines to this file")
+    fake_backend.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    servers = fake_backend.serve(seed=args.seed, **fake_backend.options(args))
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    if args.memory:
+        tracemalloc.start()
+    records = []
+    try:
+        for frontend in args.frontends:
+            samples = {}
+            for n in range(args.repeat):
+                for name, sample in run_frontend(frontend, args, workdir, n).items():
+                    samples.setdefault(name, []).append(sample)
+            for name, values in samples.items():
+                record = summarize(frontend, name, values, args)
+                records.append(record)
+                print(json.dumps(record), flush=True)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        for server in servers:
+            server.shutdown()
+    if args.output:
+        with open(args.output, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+    return records
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
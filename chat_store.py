@@ -0,0 +1,1217 @@
+import json
+import mmap
+import os
+import pickle
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from datetime import date, datetime
+from uuid import uuid4
+
+import streamlit as st
+
+from metrics import span
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DB_FILE = "conversations.db"
+# Chat id X.py keeps its single conversation under
+HISTORY_CHAT = "chat_history"
+
+# Message bodies are BLOBs: FORMAT_VERSION, a flags byte, then the payload.
+# Rows written before the binary format are JSON TEXT and are still read.
+FORMAT_VERSION = 1
+MSGPACK = 0x01  # payload is msgpack, otherwise UTF-8 JSON
+ZLIB = 0x02
+ZSTD = 0x04
+# Row holds BLOB_REF into a .blobs file instead of the payload
+BLOB = 0x08
+# Shorter payloads are stored uncompressed
+COMPRESS_MIN = 256
+# Bodies at least this large (as JSON) are stored out of line: appended to
+# an mmap-ed blob file next to the database and decoded only when read
+BLOB_MIN = 32 * 1024
+# generation, offset, length of a record in <db name>.<generation>.blobs
+BLOB_REF = struct.Struct("<IQI")
+
+# Writes between WAL checkpoints / free-page reclaim
+COMPACT_EVERY = 200
+# Size the WAL file is cut back to once a checkpoint has emptied it
+WAL_LIMIT = 4 * 2**20
+# Hits returned by ChatStore.search
+SEARCH_LIMIT = 20
+# Seconds finished background jobs are kept for their progress display
+JOB_RETENTION = 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    created_at TEXT,
+    updated_at TEXT,
+    position INTEGER NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS chats_by_position ON chats(position);
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT,
+    chat_id TEXT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+    pos INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT,
+    timestamp TEXT,
+    job TEXT,
+    PRIMARY KEY (chat_id, pos)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+    message_id TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    options TEXT NOT NULL,
+    status TEXT NOT NULL,
+    owner TEXT,
+    heartbeat REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs(status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_by_chat ON jobs(chat_id);
+CREATE TABLE IF NOT EXISTS leases (
+    job TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    heartbeat REAL NOT NULL
+);
+"""
+
+# Full-text index over chat names and message text. Rows share the rowid
+# of the chats/messages row they mirror; pending placeholders are left out.
+# message_search keeps no copy of the text (it would be most of the file):
+# it reads it back through message_text, which decodes the stored blobs
+# with a function registered on every connection.
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS chat_search USING fts5(text, tokenize='porter unicode61');
+CREATE VIEW IF NOT EXISTS message_text AS
+    SELECT rowid AS message_rowid, message_text(content) AS text FROM messages WHERE job IS NULL;
+CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(
+    text, content='message_text', content_rowid='message_rowid', tokenize='porter unicode61'
+);
+"""
+
+# Columns added after the first release: (table, column, declaration)
+COLUMNS = [
+    ("messages", "job", "TEXT"),
+    ("messages", "id", "TEXT"),
+    ("chats", "version", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+
+def new_id():
+    return uuid4().hex
+
+
+def now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M")
+
+
+def encode_content(content):
+    # x5,py keeps raw res.json() objects, so content is not always a string
+    flags = 0
+    if msgpack is not None:
+        payload = msgpack.packb(content, use_bin_type=True)
+        flags |= MSGPACK
+    else:
+        payload = json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+    if len(payload) >= COMPRESS_MIN:
+        if zstandard is not None:
+            packed, codec = zstandard.ZstdCompressor(level=3).compress(payload), ZSTD
+        else:
+            packed, codec = zlib.compress(payload, 6), ZLIB
+        if len(packed) < len(payload):
+            payload = packed
+            flags |= codec
+    return bytes((FORMAT_VERSION, flags)) + payload
+
+
+def decode_content(raw):
+    if raw is None:
+        return None
+    if isinstance(raw, str):
+        return json.loads(raw)
+    version, flags, payload = raw[0], raw[1], raw[2:]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"unsupported message format version {version}")
+    if flags & BLOB:
+        raise ValueError("out-of-line message body, read it through ChatStore")
+    if flags & ZSTD and zstandard is None or flags & MSGPACK and msgpack is None:
+        raise RuntimeError("this store was written with msgpack/zstandard; install them to read it")
+    if flags & ZSTD:
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    elif flags & ZLIB:
+        payload = zlib.decompress(payload)
+    if flags & MSGPACK:
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
+
+def content_size(content):
+    # Approximate in-memory size, for the cache usage caption
+    return len(json.dumps(content))
+
+
+def out_of_line(content):
+    return content_size(content) >= BLOB_MIN
+
+
+def blob_ref(generation, offset, length):
+    return bytes((FORMAT_VERSION, BLOB)) + BLOB_REF.pack(generation, offset, length)
+
+
+def is_blob_ref(raw):
+    return isinstance(raw, bytes) and bool(raw[1] & BLOB)
+
+
+def cached_size(msg):
+    # Bytes the cache holds for msg; out-of-line bodies are not held
+    return 0 if isinstance(msg, LazyMessage) else content_size(msg["content"])
+
+
+class LazyMessage(dict):
+    # Message whose body stays in the blob file. "content" is decoded from
+    # the mapping on every access and never kept, so a chat full of large
+    # configs only costs memory for the messages being rendered. body is
+    # (mmap, offset, length); the mapping outlives a pack_blobs() of its file.
+
+    def __init__(self, body, **fields):
+        super().__init__(**fields)
+        self.body = body
+
+    def __missing__(self, key):
+        if key != "content":
+            raise KeyError(key)
+        blob_map, offset, length = self.body
+        return decode_content(blob_map[offset:offset + length])
+
+    def __contains__(self, key):
+        return key == "content" or super().__contains__(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    # The old pickles hold dicts, lists, strings and the odd datetime
+    # (x5,py's created_at); refuse anything else that would import code
+    ALLOWED = {("datetime", "datetime"), ("datetime", "date")}
+
+    def find_class(self, module, name):
+        if (module, name) in self.ALLOWED:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"refusing to load {module}.{name} from a legacy pickle")
+
+
+def legacy_time(value):
+    # Pickled datetimes become the text the store keeps everywhere else
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M")
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def content_text(content):
+    # Searchable text of a message; raw JSON answers are indexed as JSON
+    if content is None:
+        return ""
+    return content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)
+
+
+def search_terms(query):
+    # Every word must match, each as a prefix, with FTS5 syntax quoted away
+    return " ".join('"{}"*'.format(word.replace('"', '""')) for word in query.split())
+
+
+def row_to_message(mid, role, content, timestamp, job, body=None):
+    if body is not None:
+        msg = LazyMessage(body, id=mid, role=role)
+    else:
+        msg = {"id": mid, "role": role, "content": decode_content(content)}
+    if timestamp is not None:
+        msg["timestamp"] = timestamp
+    if job is not None:
+        msg["pending"] = job
+    return msg
+
+
+class ChatStore:
+    # Append-only conversation store on top of a SQLite WAL journal.
+    # Every create/append/edit/delete is a small transaction, so one new
+    # message costs O(1) instead of re-pickling the whole history.
+    # One instance is shared by all sessions of a server process (see
+    # open_store), so every public method holds self.lock.
+    # Other processes may write the same file. Each chat carries a version
+    # bumped by every write to it; a cached chat is only patched in place
+    # while its version still matches the database, otherwise it is dropped
+    # and re-read, so concurrent writers never overwrite each other.
+
+    def __init__(self, path=DB_FILE, legacy_file=None):
+        self.path = path
+        # Pickle imported on first open; "" to skip (see migrate.py)
+        self.legacy_file = os.path.splitext(path)[0] + ".pkl" if legacy_file is None else legacy_file
+        # Why the legacy import failed, shown by open_store
+        self.legacy_error = None
+        self.lock = threading.RLock()
+        self.writes = 0
+        # chat_id -> chat, in sidebar order. Sessions iterate it without the
+        # lock, so it is never changed in place: every change publishes a
+        # new dict in one assignment.
+        self.chats = {}
+        # chat_id -> message list, filled lazily by messages()
+        self.bodies = {}
+        # chat_id -> approximate bytes of cached message content
+        self.body_bytes = {}
+        # chat_id -> cached messages whose body is mapped from a blob file
+        self.body_mapped = {}
+        # message id -> cached message, for O(1) edits by id
+        self.by_id = {}
+        # chat_id -> chats.version the cached messages correspond to
+        self.body_versions = {}
+        # blob file generation -> read-only mmap of it
+        self.blob_maps = {}
+        self.connect()
+
+    def connect(self):
+        self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA journal_size_limit={WAL_LIMIT}")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.create_function(
+            "message_text", 1, lambda raw: content_text(self._decode(raw)), deterministic=True
+        )
+        self.conn.executescript(SCHEMA)
+        self.searchable = self.create_search()
+        self.migrate()
+        self.import_legacy()
+        self.inode = os.stat(self.path).st_ino
+        self.version = self.data_version()
+        self.reload()
+
+    def reload(self):
+        # Only chats whose version moved lose their cached messages
+        chats = self.load()
+        # Remapped on demand, in case another process appended or packed
+        self.blob_maps.clear()
+        self.chats = chats
+        for cid in list(self.bodies):
+            if cid not in chats or chats[cid]["version"] != self.body_versions[cid]:
+                self.forget(cid)
+
+    def forget(self, cid):
+        for msg in self.bodies.pop(cid, []):
+            self.by_id.pop(msg["id"], None)
+        self.body_bytes.pop(cid, None)
+        self.body_mapped.pop(cid, None)
+        self.body_versions.pop(cid, None)
+
+    # Transactions
+    def begin(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        self.conn.execute("COMMIT")
+        self.writes += 1
+        if self.writes % COMPACT_EVERY == 0:
+            # Off this thread and its lock, so a slow checkpoint never stalls the sessions
+            threading.Thread(target=self.checkpoint, daemon=True, name="store-checkpoint").start()
+
+    def rollback(self):
+        self.conn.execute("ROLLBACK")
+
+    def write(self, fn, *args):
+        with self.lock, span("store_write"):
+            self.begin()
+            try:
+                result = fn(*args)
+            except Exception:
+                self.rollback()
+                raise
+            self.commit()
+            return result
+
+    def change(self, cid, fn, *args):
+        # Write transaction against one chat. BEGIN IMMEDIATE holds the
+        # database write lock, so the version read here cannot move before
+        # COMMIT. Returns (fn result, whether the cached chat may be patched).
+        def _change():
+            row = self.conn.execute("SELECT version FROM chats WHERE id = ?", (cid,)).fetchone()
+            if row is None:
+                raise KeyError(cid)
+            if self.body_versions.get(cid) != row[0]:
+                # Someone else wrote this chat since we cached it
+                self.forget(cid)
+            result = fn(*args)
+            return result, self._touch(cid)
+
+        with self.lock:
+            result, version = self.write(_change)
+            if cid in self.bodies:
+                self.body_versions[cid] = version
+                return result, True
+            return result, False
+
+    def checkpoint(self):
+        # Periodic online compaction on a connection of its own. PASSIVE
+        # copies what it can without waiting for readers, e.g. a long
+        # export; what is left goes next time.
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            conn.execute("PRAGMA incremental_vacuum").fetchall()
+        except sqlite3.Error:
+            pass
+        finally:
+            conn.close()
+
+    def compact(self):
+        # Fold the WAL back into the main file and release free pages. Waits
+        # for readers, so only for offline use (migrate.py, bench.py).
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.conn.execute("PRAGMA incremental_vacuum").fetchall()
+
+    def create_search(self):
+        # False when SQLite is built without FTS5: everything but search works
+        old = self.conn.execute("SELECT sql FROM sqlite_master WHERE name = 'message_search'").fetchone()
+        if old is not None and "content=" not in old[0]:
+            # Index from before the binary format, with its own copy of the
+            # text; dropped here and rebuilt by migrate()
+            self.write(self.drop_search)
+        try:
+            self.conn.executescript(SEARCH_SCHEMA)
+        except sqlite3.OperationalError:
+            return False
+        return True
+
+    def drop_search(self):
+        self.conn.execute("DROP TABLE message_search")
+        self.conn.execute("DELETE FROM meta WHERE key = 'search_indexed'")
+
+    def migrate(self):
+        for table, column, decl in COLUMNS:
+            existing = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+            if column not in existing:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        # Messages stored before ids existed get one now
+        self.conn.execute("UPDATE messages SET id = lower(hex(randomblob(16))) WHERE id IS NULL")
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS messages_by_id ON messages(id)")
+        # Stores written before search existed get indexed once
+        indexed = self.conn.execute("SELECT value FROM meta WHERE key = 'search_indexed'").fetchone()
+        if self.searchable and not indexed:
+            self.write(self.rebuild_search)
+
+    def rebuild_search(self):
+        self.conn.execute("DELETE FROM chat_search")
+        self.conn.execute("INSERT INTO chat_search (rowid, text) SELECT rowid, name FROM chats")
+        self.conn.execute("INSERT INTO message_search (message_search) VALUES ('rebuild')")
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('search_indexed', ?)", (now(),))
+
+    # One-shot import of the old conversations.pkl / chat_history.pkl
+    def import_legacy(self):
+        done = self.conn.execute("SELECT value FROM meta WHERE key = 'legacy_imported'").fetchone()
+        if done or not self.legacy_file or not os.path.exists(self.legacy_file):
+            return
+        try:
+            self.import_pickle(self.legacy_file)
+        except Exception as e:
+            # Not marked imported, so the next start tries again; the store
+            # itself works either way
+            self.legacy_error = f"{type(e).__name__}: {e}"
+
+    def import_pickle(self, path):
+        # X.py's flat message list or the {chat_id: chat} dict of the other
+        # frontends, one transaction per chat, dropping each chat once it is
+        # written. Chats already in the store are skipped, so an interrupted
+        # import can simply be run again. Returns (chats, messages) imported.
+        with open(path, "rb") as f:
+            data = LegacyUnpickler(f).load()
+        if isinstance(data, list):
+            data = {HISTORY_CHAT: {"name": "Chat history", "messages": data}}
+
+        def _import(cid, chat):
+            self._insert_chat(cid, chat["name"], legacy_time(chat.get("created_at")), legacy_time(chat.get("updated_at")))
+            for pos, msg in enumerate(chat.get("messages", [])):
+                if "timestamp" in msg:
+                    msg["timestamp"] = legacy_time(msg["timestamp"])
+                self._insert_message(cid, pos, msg)
+
+        chats = messages = 0
+        for cid in list(data):
+            chat, data[cid] = data[cid], None
+            if self.conn.execute("SELECT 1 FROM chats WHERE id = ?", (cid,)).fetchone():
+                continue
+            self.write(_import, cid, chat)
+            chats += 1
+            messages += len(chat.get("messages", []))
+        self.write(
+            lambda: self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_imported', ?)", (now(),))
+        )
+        return chats, messages
+
+    # JSONL transfer (see transfer.py): one record per message
+    def export_records(self, cids):
+        # Records of the given chats, read from a snapshot on a connection of
+        # their own and decoded one row at a time; nothing is cached, so
+        # memory stays flat however large the export
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        try:
+            conn.execute("BEGIN")
+            for cid in cids:
+                chat = conn.execute(
+                    "SELECT name, created_at, updated_at FROM chats WHERE id = ?", (cid,)
+                ).fetchone()
+                if chat is None:
+                    continue
+                for mid, role, raw, timestamp in conn.execute(
+                    "SELECT id, role, content, timestamp FROM messages WHERE chat_id = ? AND job IS NULL ORDER BY pos",
+                    (cid,),
+                ):
+                    with self.lock:
+                        content = self._decode(raw)
+                    yield {
+                        "chat_id": cid,
+                        "chat_name": chat[0],
+                        "chat_created_at": chat[1],
+                        "chat_updated_at": chat[2],
+                        "id": mid,
+                        "role": role,
+                        "content": content,
+                        "timestamp": timestamp,
+                    }
+        finally:
+            conn.close()
+
+    def import_records(self, records, checkpoint=None):
+        # Appends records (as export_records yields them) to their chats in
+        # one transaction, creating missing chats. Messages whose id is
+        # already stored are skipped, so importing twice changes nothing.
+        # checkpoint, a meta (key, value), is saved in the same transaction.
+        # Returns how many messages were added.
+        def _import():
+            added = 0
+            ends = {}
+            # Chats keep their exported dates unless they changed here later
+            updated = {}
+            for record in records:
+                cid = record["chat_id"]
+                if self.conn.execute("SELECT 1 FROM messages WHERE id = ?", (record["id"],)).fetchone():
+                    continue
+                if cid not in ends:
+                    row = self.conn.execute("SELECT updated_at FROM chats WHERE id = ?", (cid,)).fetchone()
+                    if row is None:
+                        created_at = record.get("chat_created_at") or now()
+                        self._insert_chat(cid, record["chat_name"], created_at, created_at)
+                        row = (created_at,)
+                    updated[cid] = row[0]
+                    ends[cid] = self.conn.execute(
+                        "SELECT COALESCE(MAX(pos), -1) + 1 FROM messages WHERE chat_id = ?", (cid,)
+                    ).fetchone()[0]
+                msg = {"id": record["id"], "role": record["role"], "content": record["content"]}
+                if record.get("timestamp") is not None:
+                    msg["timestamp"] = record["timestamp"]
+                self._insert_message(cid, ends[cid], msg)
+                ends[cid] += 1
+                # Chats migrated from the pickles may have no date at all
+                updated[cid] = max(updated[cid] or "", record.get("chat_updated_at") or now())
+                added += 1
+            for cid, updated_at in updated.items():
+                self._touch(cid, updated_at)
+            if checkpoint is not None:
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", checkpoint)
+            return added
+
+        with self.lock:
+            added = self.write(_import)
+            # New chats appear and changed ones are re-read lazily
+            self.reload()
+        return added
+
+    def meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+
+    def recompress(self, batch=500):
+        # Rewrite rows still stored as JSON text in the binary format, and
+        # move large bodies stored inline out of line; returns how many rows
+        # were converted
+        def _convert(rows):
+            updates = []
+            for rowid, raw in rows:
+                content = decode_content(raw)
+                if isinstance(raw, str) or out_of_line(content):
+                    updates.append((self._encode(content), rowid))
+            self.conn.executemany("UPDATE messages SET content = ? WHERE rowid = ?", updates)
+            return len(updates)
+
+        converted = last = 0
+        while True:
+            with self.lock:
+                # Inline rows shorter than this practically never decode
+                # to BLOB_MIN, the rest are decoded to check
+                rows = self.conn.execute(
+                    "SELECT rowid, content FROM messages WHERE rowid > ? AND (typeof(content) = 'text' "
+                    "OR length(content) >= ? AND substr(content, 2, 1) != ?) ORDER BY rowid LIMIT ?",
+                    (last, BLOB_MIN // 32, bytes((BLOB,)), batch),
+                ).fetchall()
+                if not rows:
+                    break
+                converted += self.write(_convert, rows)
+            last = rows[-1][0]
+        self.compact()
+        return converted
+
+    # Out-of-line bodies. The blob file only grows: edited and deleted
+    # bodies stay in it until pack_blobs() copies the live ones into the
+    # next generation. Appends happen inside a write transaction, so the
+    # SQLite write lock also serializes them across processes.
+    def _blob_path(self, generation):
+        return f"{os.path.splitext(self.path)[0]}.{generation}.blobs"
+
+    def _blob_generation(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'blob_generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _blob_body(self, raw):
+        # (mmap, offset, length) of an out-of-line body
+        generation, offset, length = BLOB_REF.unpack(raw[2:])
+        blob_map = self.blob_maps.get(generation)
+        if blob_map is None or len(blob_map) < offset + length:
+            # First read, or the file grew since it was mapped
+            with open(self._blob_path(generation), "rb") as f:
+                blob_map = self.blob_maps[generation] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return blob_map, offset, length
+
+    def _encode(self, content):
+        record = encode_content(content)
+        if not out_of_line(content):
+            return record
+        generation = self._blob_generation()
+        with open(self._blob_path(generation), "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(record)
+            f.flush()
+            # On disk before the row pointing at it commits
+            os.fsync(f.fileno())
+        return blob_ref(generation, offset, len(record))
+
+    def _decode(self, raw):
+        if is_blob_ref(raw):
+            blob_map, offset, length = self._blob_body(raw)
+            raw = blob_map[offset:offset + length]
+        return decode_content(raw)
+
+    def pack_blobs(self):
+        # Copy the live out-of-line bodies into a new blob file and delete
+        # the old one; returns the bytes reclaimed. Sessions already holding
+        # a body keep reading the old mapping, but a process that loads a
+        # chat in the middle can miss the file, so run it with the app
+        # stopped (see migrate.py).
+        def _pack():
+            old = self._blob_generation()
+            new = old + 1
+            where = "typeof(content) = 'blob' AND substr(content, 2, 1) = ?"
+            rows = self.conn.execute(f"SELECT rowid, content FROM messages WHERE {where}", (bytes((BLOB,)),)).fetchall()
+            updates = []
+            with open(self._blob_path(new), "wb") as f:
+                for rowid, raw in rows:
+                    blob_map, offset, length = self._blob_body(raw)
+                    updates.append((blob_ref(new, f.tell(), length), rowid))
+                    f.write(blob_map[offset:offset + length])
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            self.conn.executemany("UPDATE messages SET content = ? WHERE rowid = ?", updates)
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('blob_generation', ?)", (str(new),))
+            # Other processes drop their cached refs on the next refresh
+            self.conn.execute(
+                f"UPDATE chats SET version = version + 1 WHERE id IN (SELECT chat_id FROM messages WHERE {where})",
+                (bytes((BLOB,)),),
+            )
+            return old, size
+
+        with self.lock:
+            old, size = self.write(_pack)
+            path = self._blob_path(old)
+            reclaimed = os.path.getsize(path) - size if os.path.exists(path) else 0
+            if os.path.exists(path):
+                os.remove(path)
+            self.blob_maps.clear()
+            self.reload()
+        return reclaimed
+
+    # Sidebar index: chat metadata only, never the message bodies
+    def load(self):
+        chats = {}
+        for cid, name, created_at, updated_at, version in self.conn.execute(
+            "SELECT id, name, created_at, updated_at, version FROM chats ORDER BY position"
+        ):
+            chats[cid] = {"name": name, "created_at": created_at, "updated_at": updated_at, "version": version}
+        return chats
+
+    def messages(self, cid):
+        with self.lock:
+            if cid in self.bodies:
+                return self.bodies[cid]
+            with span("store_load"):
+                # Version first: a write landing in between only makes the
+                # cache look stale, never newer than it is
+                row = self.conn.execute("SELECT version FROM chats WHERE id = ?", (cid,)).fetchone()
+                rows = self.conn.execute(
+                    "SELECT id, role, content, timestamp, job FROM messages WHERE chat_id = ? ORDER BY pos", (cid,)
+                ).fetchall()
+                self.bodies[cid] = [
+                    row_to_message(*row, body=self._blob_body(row[2]) if is_blob_ref(row[2]) else None)
+                    for row in rows
+                ]
+                self.body_bytes[cid] = sum(cached_size(msg) for msg in self.bodies[cid])
+                self.body_mapped[cid] = sum(isinstance(msg, LazyMessage) for msg in self.bodies[cid])
+                self.by_id.update((msg["id"], msg) for msg in self.bodies[cid])
+                self.body_versions[cid] = row[0] if row else 0
+            return self.bodies[cid]
+
+    # Cache invalidation: data_version changes whenever another connection
+    # (another server process, a CLI import, ...) commits to the file
+    def data_version(self):
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def refresh(self):
+        with self.lock:
+            try:
+                replaced = os.stat(self.path).st_ino != self.inode
+            except FileNotFoundError:
+                replaced = True
+            if replaced:
+                # The file was deleted or swapped underneath us: start over
+                self.conn.close()
+                self.connect()
+                return
+            version = self.data_version()
+            if version != self.version:
+                self.version = version
+                self.reload()
+
+    def memory_usage(self):
+        with self.lock:
+            return {
+                "chats": len(self.chats),
+                "cached_chats": len(self.bodies),
+                "cached_messages": sum(len(messages) for messages in self.bodies.values()),
+                "cached_bytes": sum(self.body_bytes.values()),
+                "mapped_messages": sum(self.body_mapped.values()),
+            }
+
+    def describe_usage(self):
+        usage = self.memory_usage()
+        return (
+            f"Store cache: {usage['cached_chats']}/{usage['chats']} chats, "
+            f"{usage['cached_messages']} messages, {usage['cached_bytes'] / 1024:.1f} KiB"
+            f" ({usage['mapped_messages']} mapped)"
+        )
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        # Ranked hits across every chat: name matches first, then messages
+        # by bm25. Each hit is {"chat_id", "message_id", "role", "snippet"}
+        # with matched words in **bold**; message_id is None for name hits.
+        terms = search_terms(query)
+        if not terms or not self.searchable:
+            return []
+        with self.lock:
+            names = self.conn.execute(
+                "SELECT c.id, highlight(chat_search, 0, '**', '**') FROM chat_search "
+                "JOIN chats c ON c.rowid = chat_search.rowid WHERE chat_search MATCH ? ORDER BY rank LIMIT ?",
+                (terms, limit),
+            ).fetchall()
+            messages = self.conn.execute(
+                "SELECT m.chat_id, m.id, m.role, snippet(message_search, 0, '**', '**', '…', 12) FROM message_search "
+                "JOIN messages m ON m.rowid = message_search.rowid WHERE message_search MATCH ? ORDER BY rank LIMIT ?",
+                (terms, limit),
+            ).fetchall()
+        hits = [{"chat_id": cid, "message_id": None, "role": None, "snippet": name} for cid, name in names]
+        hits += [{"chat_id": cid, "message_id": mid, "role": role, "snippet": text} for cid, mid, role, text in messages]
+        return hits[:limit]
+
+    # Low-level writers, called inside a transaction
+    def _index(self, table, rowid, text):
+        if self.searchable:
+            self.conn.execute(f"DELETE FROM {table} WHERE rowid = ?", (rowid,))
+            if text:
+                self.conn.execute(f"INSERT INTO {table} (rowid, text) VALUES (?, ?)", (rowid, text))
+
+    def _index_message(self, rowid, content):
+        if self.searchable:
+            self.conn.execute("INSERT INTO message_search (rowid, text) VALUES (?, ?)", (rowid, content_text(content)))
+
+    def _unindex_messages(self, where, params):
+        # message_search drops a row only when handed back the text it
+        # indexed, so this runs before the messages change
+        if self.searchable:
+            rows = self.conn.execute(
+                f"SELECT rowid, content FROM messages WHERE job IS NULL AND {where}", params
+            ).fetchall()
+            for rowid, raw in rows:
+                self.conn.execute(
+                    "INSERT INTO message_search (message_search, rowid, text) VALUES ('delete', ?, ?)",
+                    (rowid, content_text(self._decode(raw))),
+                )
+
+    def _rowid(self, mid):
+        return self.conn.execute("SELECT rowid FROM messages WHERE id = ?", (mid,)).fetchone()[0]
+
+    def _insert_chat(self, cid, name, created_at, updated_at):
+        position = self.conn.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM chats").fetchone()[0]
+        cur = self.conn.execute(
+            "INSERT INTO chats (id, name, created_at, updated_at, position) VALUES (?, ?, ?, ?, ?)",
+            (cid, name, created_at, updated_at, position),
+        )
+        self._index("chat_search", cur.lastrowid, name)
+
+    def _insert_message(self, cid, pos, msg):
+        msg.setdefault("id", new_id())
+        cur = self.conn.execute(
+            "INSERT INTO messages (id, chat_id, pos, role, content, timestamp, job) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (msg["id"], cid, pos, msg["role"], self._encode(msg["content"]), msg.get("timestamp"), msg.get("pending")),
+        )
+        # Placeholders are indexed once resolve_pending stores the answer
+        if "pending" not in msg:
+            self._index_message(cur.lastrowid, msg["content"])
+
+    def _position(self, cid, mid):
+        row = self.conn.execute("SELECT pos FROM messages WHERE id = ? AND chat_id = ?", (mid, cid)).fetchone()
+        if row is None:
+            raise KeyError(mid)
+        return row[0]
+
+    def _shift(self, cid, start, delta):
+        # Two passes so the (chat_id, pos) key never collides mid-update
+        self.conn.execute(
+            "UPDATE messages SET pos = -(pos + ?) - 1 WHERE chat_id = ? AND pos >= ?", (delta, cid, start)
+        )
+        self.conn.execute("UPDATE messages SET pos = -pos - 1 WHERE chat_id = ? AND pos < 0", (cid,))
+
+    def _touch(self, cid, updated_at=None):
+        # Every write to a chat bumps its version; returns the new one
+        updated_at = updated_at or now()
+        self.conn.execute("UPDATE chats SET updated_at = ?, version = version + 1 WHERE id = ?", (updated_at, cid))
+        version = self.conn.execute("SELECT version FROM chats WHERE id = ?", (cid,)).fetchone()[0]
+        if cid in self.chats:
+            self.chats[cid]["updated_at"] = updated_at
+            self.chats[cid]["version"] = version
+        return version
+
+    # Public API used by the frontends
+    def create_chat(self, name, cid=None):
+        cid = cid or str(uuid4())
+        timestamp = now()
+        with self.lock:
+            self.write(self._insert_chat, cid, name, timestamp, timestamp)
+            chat = {"name": name, "created_at": timestamp, "updated_at": timestamp, "version": 0}
+            self.chats = {**self.chats, cid: chat}
+            self.bodies[cid] = []
+            self.body_bytes[cid] = 0
+            self.body_mapped[cid] = 0
+            self.body_versions[cid] = 0
+        return cid
+
+    def ensure_chat(self, cid, name):
+        # Create chat cid unless it exists, e.g. X.py's single conversation
+        with self.lock:
+            if cid in self.chats:
+                return
+            try:
+                self.create_chat(name, cid)
+            except sqlite3.IntegrityError:
+                # Another process created it first
+                self.reload()
+
+    def rename_chat(self, cid, name):
+        def _rename():
+            self.conn.execute("UPDATE chats SET name = ? WHERE id = ?", (name, cid))
+            row = self.conn.execute("SELECT rowid FROM chats WHERE id = ?", (cid,)).fetchone()
+            self._index("chat_search", row[0], name)
+
+        with self.lock:
+            self.change(cid, _rename)
+            self.chats[cid]["name"] = name
+
+    def delete_chat(self, cid):
+        def _delete():
+            self._unindex_messages("chat_id = ?", (cid,))
+            for (rowid,) in self.conn.execute("SELECT rowid FROM chats WHERE id = ?", (cid,)).fetchall():
+                self._index("chat_search", rowid, "")
+            self.conn.execute("DELETE FROM chats WHERE id = ?", (cid,))
+
+        with self.lock:
+            self.write(_delete)
+            self.chats = {key: chat for key, chat in self.chats.items() if key != cid}
+            self.forget(cid)
+
+    def message(self, mid):
+        # Cached message by id, None if its chat is not loaded
+        return self.by_id.get(mid)
+
+    def index_of(self, cid, mid):
+        with self.lock:
+            return self._position(cid, mid)
+
+    def append_message(self, cid, msg):
+        return self.insert_message(cid, None, msg)
+
+    def insert_after(self, cid, mid, msg):
+        def _after():
+            return self._position(cid, mid) + 1
+
+        return self.insert_message(cid, _after, msg)
+
+    def insert_message(self, cid, index, msg):
+        # index is a position, None to append, or a callable computing the
+        # position inside the transaction, from the database rather than the
+        # cache, so it is right even when another writer got there first.
+        # Returns that position; the new id is in msg["id"].
+        def _insert():
+            if index is None:
+                pos = self.conn.execute(
+                    "SELECT COALESCE(MAX(pos), -1) + 1 FROM messages WHERE chat_id = ?", (cid,)
+                ).fetchone()[0]
+            else:
+                pos = index() if callable(index) else index
+            self._shift(cid, pos, 1)
+            self._insert_message(cid, pos, msg)
+            return pos
+
+        with self.lock:
+            pos, cached = self.change(cid, _insert)
+            if cached and out_of_line(msg["content"]):
+                # Re-read so the cache maps the body instead of holding it
+                self.forget(cid)
+            elif cached:
+                self.bodies[cid].insert(pos, msg)
+                self.by_id[msg["id"]] = msg
+                self.body_bytes[cid] += content_size(msg["content"])
+        return pos
+
+    def edit_message(self, cid, mid, content):
+        def _edit():
+            self._unindex_messages("id = ? AND chat_id = ?", (mid, cid))
+            cur = self.conn.execute(
+                "UPDATE messages SET content = ? WHERE id = ? AND chat_id = ?",
+                (self._encode(content), mid, cid),
+            )
+            if not cur.rowcount:
+                raise KeyError(mid)
+            self._index_message(self._rowid(mid), content)
+
+        with self.lock:
+            _, cached = self.change(cid, _edit)
+            msg = self.by_id.get(mid)
+            if cached and msg is not None and (isinstance(msg, LazyMessage) or out_of_line(content)):
+                self.forget(cid)
+            elif cached and msg is not None:
+                self.body_bytes[cid] += content_size(content) - content_size(msg["content"])
+                msg["content"] = content
+
+    def delete_message(self, cid, mid):
+        def _delete():
+            pos = self._position(cid, mid)
+            self._unindex_messages("id = ?", (mid,))
+            self.conn.execute("DELETE FROM messages WHERE id = ?", (mid,))
+            # A deleted placeholder's job has nowhere to put its answer; a
+            # worker already running it finds nothing to resolve
+            self.conn.execute(
+                "DELETE FROM jobs WHERE message_id = ? AND status IN ('queued', 'running')", (mid,)
+            )
+            self._shift(cid, pos + 1, -1)
+            return pos
+
+        with self.lock:
+            pos, cached = self.change(cid, _delete)
+            msg = self.by_id.pop(mid, None)
+            if cached and msg is not None:
+                self.body_bytes[cid] -= cached_size(msg)
+                self.body_mapped[cid] -= isinstance(msg, LazyMessage)
+                del self.bodies[cid][pos]
+
+    def replace_answers(self, answers):
+        # answers: chat_id -> [(user message id, new answer)], all written in
+        # one transaction. The assistant message right after each prompt is
+        # overwritten, or inserted if the prompt never got one. Prompts
+        # deleted meanwhile and replies still pending are left alone.
+        def _replace():
+            for cid, pairs in answers.items():
+                if self.conn.execute("SELECT 1 FROM chats WHERE id = ?", (cid,)).fetchone() is None:
+                    continue
+                for mid, content in pairs:
+                    try:
+                        pos = self._position(cid, mid)
+                    except KeyError:
+                        continue
+                    row = self.conn.execute(
+                        "SELECT id, role, job FROM messages WHERE chat_id = ? AND pos = ?", (cid, pos + 1)
+                    ).fetchone()
+                    if row is not None and row[1] == "assistant":
+                        if row[2] is None:
+                            self._unindex_messages("id = ?", (row[0],))
+                            self.conn.execute(
+                                "UPDATE messages SET content = ? WHERE id = ?", (self._encode(content), row[0])
+                            )
+                            self._index_message(self._rowid(row[0]), content)
+                    else:
+                        self._shift(cid, pos + 1, 1)
+                        self._insert_message(cid, pos + 1, {"role": "assistant", "content": content})
+                self._touch(cid)
+
+        with self.lock:
+            self.write(_replace)
+            # Re-read lazily rather than patching many cached lists
+            for cid in answers:
+                self.forget(cid)
+
+    # Placeholders for replies computed in the background (see QueryDispatcher)
+    def pending_jobs(self, cid):
+        # (message id, job id) for every placeholder in the chat
+        with self.lock:
+            return [(msg["id"], msg["pending"]) for msg in self.messages(cid) if "pending" in msg]
+
+    def lease_pending(self, owner, jobs):
+        # Heartbeat for the placeholders `owner` is computing, so that other
+        # processes polling the chat leave them alone (see poll_pending).
+        # resolve_pending drops the lease; long abandoned ones go here.
+        def _lease():
+            stamp = time.time()
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO leases (job, owner, heartbeat) VALUES (?, ?, ?)",
+                [(job, owner, stamp) for job in jobs],
+            )
+            self.conn.execute("DELETE FROM leases WHERE heartbeat < ?", (stamp - JOB_RETENTION,))
+
+        self.write(_lease)
+
+    def leased_jobs(self, jobs, owner, lease):
+        # The subset of job ids another owner renewed within the last `lease` seconds
+        if not jobs:
+            return set()
+        with self.lock:
+            marks = ",".join("?" * len(jobs))
+            return {
+                row[0]
+                for row in self.conn.execute(
+                    f"SELECT job FROM leases WHERE job IN ({marks}) AND owner != ? AND heartbeat >= ?",
+                    [*jobs, owner, time.time() - lease],
+                )
+            }
+
+    def preview_pending(self, cid, mid, job, content):
+        # Partial answer for display only, nothing is written to disk
+        with self.lock:
+            msg = self.by_id.get(mid)
+            if msg is not None and msg.get("pending") == job:
+                self.body_bytes[cid] += content_size(content) - content_size(msg["content"])
+                msg["content"] = content
+
+    def resolve_pending(self, cid, mid, job, content, failed=False):
+        # Stores the answer; a durable job (see enqueue_jobs) is closed in
+        # the same transaction
+        def _resolve():
+            cur = self.conn.execute(
+                "UPDATE messages SET content = ?, job = NULL WHERE id = ? AND job = ?",
+                (self._encode(content), mid, job),
+            )
+            # Placeholders were never indexed, so there is nothing to remove
+            if cur.rowcount:
+                self._index_message(self._rowid(mid), content)
+            self.conn.execute("DELETE FROM leases WHERE job = ?", (job,))
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status IN ('queued', 'running')",
+                ("failed" if failed else "done", time.time(), job),
+            )
+
+        with self.lock:
+            try:
+                _, cached = self.change(cid, _resolve)
+            except KeyError:
+                # The chat was deleted while the reply was computed
+                return
+            msg = self.by_id.get(mid)
+            if cached and msg is not None and msg.get("pending") == job and out_of_line(content):
+                self.forget(cid)
+            elif cached and msg is not None and msg.get("pending") == job:
+                self.body_bytes[cid] += content_size(content) - content_size(msg["content"])
+                msg["content"] = content
+                del msg["pending"]
+
+
+    # Durable background jobs (see job_queue.py). A job row and the
+    # placeholder its answer goes into are written in one transaction, so
+    # neither survives a crash without the other.
+    def enqueue_jobs(self, cid, prompts, placeholder, options="{}", after=None):
+        # Per prompt a user message and a pending answer at the end of the
+        # chat; with `after`, only the answer, after that message id.
+        # Returns the job ids.
+        def _enqueue():
+            if after is not None:
+                pos = self._position(cid, after) + 1
+            else:
+                pos = self.conn.execute(
+                    "SELECT COALESCE(MAX(pos), -1) + 1 FROM messages WHERE chat_id = ?", (cid,)
+                ).fetchone()[0]
+            inserted = []
+            for prompt in prompts:
+                job = new_id()
+                msgs = [] if after is not None else [{"role": "user", "content": prompt}]
+                msgs.append({"role": "assistant", "content": placeholder, "pending": job})
+                for msg in msgs:
+                    self._shift(cid, pos, 1)
+                    self._insert_message(cid, pos, msg)
+                    inserted.append((pos, msg))
+                    pos += 1
+                self.conn.execute(
+                    "INSERT INTO jobs (id, chat_id, message_id, prompt, options, status, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, 'queued', ?)",
+                    (job, cid, msgs[-1]["id"], prompt, options, time.time()),
+                )
+            return inserted
+
+        with self.lock:
+            inserted, cached = self.change(cid, _enqueue)
+            if cached and any(out_of_line(msg["content"]) for _, msg in inserted):
+                self.forget(cid)
+            elif cached:
+                for pos, msg in inserted:
+                    self.bodies[cid].insert(pos, msg)
+                    self.by_id[msg["id"]] = msg
+                    self.body_bytes[cid] += content_size(msg["content"])
+        return [msg["pending"] for _, msg in inserted if "pending" in msg]
+
+    def claim_job(self, owner, lease):
+        # Oldest queued job, or a running one whose owner stopped renewing
+        # its lease (crashed, restarted), marked running for `owner`.
+        # Returns (id, chat_id, message_id, prompt, options, attempts before
+        # this one) or None.
+        claimable = (
+            "(status = 'queued' OR (status = 'running' AND heartbeat < ?)) "
+            "AND EXISTS (SELECT 1 FROM messages WHERE id = jobs.message_id AND job = jobs.id)"
+        )
+
+        def _claim():
+            row = self.conn.execute(
+                "SELECT id, chat_id, message_id, prompt, options, attempts FROM jobs "
+                f"WHERE {claimable} ORDER BY created_at, rowid LIMIT 1",
+                (stale,),
+            ).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'running', owner = ?, heartbeat = ?, attempts = attempts + 1 "
+                    "WHERE id = ?",
+                    (owner, time.time(), row[0]),
+                )
+            return row
+
+        stale = time.time() - lease
+        with self.lock:
+            # Look before taking the write lock; idle workers poll this
+            if self.conn.execute(f"SELECT 1 FROM jobs WHERE {claimable} LIMIT 1", (stale,)).fetchone() is None:
+                return None
+            return self.write(_claim)
+
+    def renew_jobs(self, owner):
+        # Heartbeat for owner's running jobs; drops long finished ones and
+        # those whose placeholder was deleted before they ran
+        def _renew():
+            self.conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status = 'running'", (time.time(), owner)
+            )
+            self.conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (time.time() - JOB_RETENTION,),
+            )
+            self.conn.execute(
+                "DELETE FROM jobs WHERE status = 'queued' AND NOT EXISTS "
+                "(SELECT 1 FROM messages WHERE id = jobs.message_id AND job = jobs.id)"
+            )
+
+        self.write(_renew)
+
+    def active_jobs(self, jobs):
+        # The subset of job ids still queued or running
+        if not jobs:
+            return set()
+        with self.lock:
+            marks = ",".join("?" * len(jobs))
+            return {
+                row[0]
+                for row in self.conn.execute(
+                    f"SELECT id FROM jobs WHERE id IN ({marks}) AND status IN ('queued', 'running')", list(jobs)
+                )
+            }
+
+    def job_counts(self, cid):
+        # status -> number of the chat's jobs
+        with self.lock:
+            return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs WHERE chat_id = ? GROUP BY status", (cid,)))
+
+    def retry_jobs(self, cid, placeholder):
+        # Queue the chat's failed jobs again; their answers go back to
+        # pending. Returns the job ids.
+        def _retry():
+            rows = self.conn.execute(
+                "SELECT jobs.id, jobs.message_id FROM jobs JOIN messages ON messages.id = jobs.message_id "
+                "WHERE jobs.chat_id = ? AND jobs.status = 'failed' AND messages.job IS NULL",
+                (cid,),
+            ).fetchall()
+            for job, mid in rows:
+                self._unindex_messages("id = ?", (mid,))
+                self.conn.execute(
+                    "UPDATE messages SET content = ?, job = ? WHERE id = ?", (self._encode(placeholder), job, mid)
+                )
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'queued', owner = NULL, attempts = 0, finished_at = NULL, "
+                    "created_at = ? WHERE id = ?",
+                    (time.time(), job),
+                )
+            return [job for job, _ in rows]
+
+        with self.lock:
+            retried, _ = self.change(cid, _retry)
+            # Re-read lazily rather than patching each placeholder
+            self.forget(cid)
+            return retried
+
+
+# One store per server process, shared read-only by every session
+@st.cache_resource(show_spinner=False)
+def shared_store(path):
+    return ChatStore(path)
+
+
+def open_store(path=DB_FILE):
+    store = shared_store(path)
+    with span("store_refresh"):
+        store.refresh()
+    if store.legacy_error:
+        st.warning(f"Could not import {store.legacy_file} ({store.legacy_error}); starting without it.")
+    return store
@@ -0,0 +1,382 @@
+import difflib
+import hashlib
+import html
+import json
+import os
+import re
+import tempfile
+
+import streamlit as st
+from streamlit.errors import StreamlitAPIException
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from metrics import registry
+from query_client import POLL_INTERVAL, poll_pending, shared_cache, shared_client, shared_dispatcher
+from transfer import export_jsonl, import_jsonl
+
+# Messages rendered per page of a conversation
+PAGE_SIZE = 20
+# Older user turns listed in the collapsed summary
+SUMMARY_LINES = 50
+# Answers past either limit are shown collapsed, as a preview of their
+# first PREVIEW_LINES; the full config is only rendered on request
+COLLAPSE_LINES = 40
+COLLAPSE_CHARS = 4000
+PREVIEW_LINES = 8
+# Per-frontend stylesheets (and scripts), see inject_theme
+THEME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "themes")
+
+
+@st.cache_resource(show_spinner=False)
+def theme_assets(name):
+    # (css, js) of themes/<name>.css and .js, read once per process
+    assets = []
+    for ext in (".css", ".js"):
+        path = os.path.join(THEME_DIR, name + ext)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                assets.append(f.read())
+        else:
+            assets.append("")
+    return tuple(assets)
+
+
+def js_string(text):
+    # JavaScript string literal that is safe inside a <script> element
+    return json.dumps(text).replace("</", "<\\/")
+
+
+def inject_theme(name):
+    # Put the theme into the page once per session instead of resending a
+    # <style> block on every rerun. An empty iframe appends it to the
+    # parent document, where it outlives the iframe itself.
+    key = f"theme_{name}"
+    if st.session_state.get(key):
+        return
+    st.session_state[key] = True
+    css, js = theme_assets(name)
+    st.iframe(
+        f"""<script>
+        const doc = window.parent.document;
+        if (!doc.getElementById("theme-{name}")) {{
+            const style = doc.createElement("style");
+            style.id = "theme-{name}";
+            style.textContent = {js_string(css)};
+            doc.head.appendChild(style);
+            const code = {js_string(js)};
+            if (code) {{
+                const script = doc.createElement("script");
+                script.textContent = code;
+                doc.head.appendChild(script);
+            }}
+        }}
+        </script>""",
+        height="content",
+    )
+
+
+def show_earlier(key):
+    st.session_state[key] += PAGE_SIZE
+
+
+def message_window(messages, chat_id, summary=True):
+    # Only the newest messages get widgets. Returns the index of the first
+    # message to render; older ones sit behind "load earlier" and an
+    # optional collapsed one-line-per-turn summary.
+    key = f"window_{chat_id}"
+    size = st.session_state.setdefault(key, PAGE_SIZE)
+    start = max(0, len(messages) - size)
+    if not start:
+        return 0
+
+    st.button(
+        f"⬆️ Load {min(PAGE_SIZE, start)} earlier messages",
+        key=f"{key}_more",
+        on_click=show_earlier,
+        args=(key,),
+    )
+    if summary:
+        turns = [msg["content"] for msg in messages[:start] if msg["role"] == "user"]
+        with st.expander(f"{start} earlier messages ({len(turns)} questions)"):
+            lines = [f"- {preview(turn)}" for turn in turns[-SUMMARY_LINES:]]
+            if len(turns) > SUMMARY_LINES:
+                lines.insert(0, f"- … {len(turns) - SUMMARY_LINES} more")
+            st.markdown("\n".join(lines))
+    return start
+
+
+def preview(content, length=80):
+    text = " ".join(str(content).split())
+    return text if len(text) <= length else text[:length] + "…"
+
+
+def config_text(content):
+    # (text, highlight language) of an answer; x5,py stores raw JSON objects
+    if not isinstance(content, str):
+        return json.dumps(content, indent=2, ensure_ascii=False), "json"
+    fence = re.match(r"\s*```(\w*)\n(.*?)\n?```\s*$", content, re.S)
+    if fence:
+        return fence.group(2), fence.group(1) or None
+    if content.lstrip()[:1] in ("{", "["):
+        try:
+            json.loads(content)
+            return content, "json"
+        except ValueError:
+            pass
+    if re.match(r"\s*[\w.-]+:(\s|$)", content):
+        return content, "yaml"
+    return content, None
+
+
+def is_long(content):
+    text = content if isinstance(content, str) else json.dumps(content)
+    return len(text) > COLLAPSE_CHARS or text.count("\n") >= COLLAPSE_LINES
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def config_diff(old, new):
+    # Keyed on both texts, so each pair of versions is diffed once
+    diff = difflib.unified_diff(old.splitlines(True), new.splitlines(True), "previous", "this")
+    return "".join(diff) or "No changes."
+
+
+def decoded(msg, contents):
+    # msg["content"] through contents (message id -> content), so a blob body
+    # is decoded once per render however often it is looked at
+    if msg["id"] not in contents:
+        contents[msg["id"]] = msg["content"]
+    return contents[msg["id"]]
+
+
+def config_answer(messages, i, contents, bubble):
+    # Long answer messages[i] as a preview inside `bubble` (HTML with one
+    # {} slot). The highlighted config and the diff against the previous
+    # long answer in the chat are only built and sent when toggled on.
+    # contents is the render's decoded bodies, see decoded().
+    msg_id = messages[i]["id"]
+    text, language = config_text(decoded(messages[i], contents))
+    lines = text.splitlines()
+    more = f"<br><small>… {len(lines) - PREVIEW_LINES} more lines</small>" if len(lines) > PREVIEW_LINES else ""
+    # Newlines as entities: a blank line would end the markdown HTML block
+    head = "&#10;".join(html.escape(line) for line in lines[:PREVIEW_LINES])
+    st.markdown(bubble.format(f"<pre>{head}</pre>{more}"), unsafe_allow_html=True)
+    cols = st.columns(2)
+    full = cols[0].toggle(f"Show full {language or 'answer'} ({len(lines)} lines)", key=f"full_{msg_id}")
+    earlier = any(msg["role"] == "assistant" for msg in messages[:i])
+    diff = earlier and cols[1].toggle("Diff with previous config", key=f"diff_{msg_id}")
+    if full:
+        st.code(text, language=language, line_numbers=True)
+    if diff:
+        previous = next(
+            (
+                decoded(msg, contents)
+                for msg in reversed(messages[:i])
+                if msg["role"] == "assistant" and "pending" not in msg and is_long(decoded(msg, contents))
+            ),
+            None,
+        )
+        if previous is None:
+            st.caption("No earlier config in this chat.")
+        else:
+            st.code(config_diff(config_text(previous)[0], text), language="diff")
+
+
+def similar_offer(prompt, match):
+    # An earlier near-duplicate of prompt has an answer (suggest_similar).
+    # Returns "use" to reuse it, "ask" to send prompt anyway or "cancel",
+    # once one of the buttons is clicked.
+    score, earlier, answer = match
+    st.info(f"A {score:.0%} similar request was answered before: “{preview(earlier)}”")
+    text, language = config_text(answer)
+    lines = text.splitlines()
+    with st.expander(f"Earlier answer ({len(lines)} lines)"):
+        st.code("\n".join(lines[:COLLAPSE_LINES]) + ("\n…" if len(lines) > COLLAPSE_LINES else ""), language=language)
+    cols = st.columns(3)
+    if cols[0].button("♻️ Use this answer", key="similar_use"):
+        shared_cache().similar.reuse()
+        return "use"
+    if cols[1].button("📨 Ask anyway", key="similar_ask"):
+        return "ask"
+    if cols[2].button("✖ Cancel", key="similar_cancel"):
+        return "cancel"
+    return None
+
+
+def open_hit(store, chat_id, msg_id):
+    # Switch to the chat and widen its window far enough to show the hit
+    st.session_state.active_chat_id = chat_id
+    st.session_state.edit_id = None
+    if msg_id is not None:
+        total = len(store.messages(chat_id))
+        key = f"window_{chat_id}"
+        size = st.session_state.get(key, PAGE_SIZE)
+        st.session_state[key] = max(size, total - store.index_of(chat_id, msg_id))
+
+
+@st.fragment
+def search_panel(store):
+    # Sidebar search over every conversation; typing only reruns this panel
+    query = st.text_input("🔍 Search conversations", key="search_query")
+    if not query.strip():
+        return
+    if not store.searchable:
+        st.caption("Search is unavailable: this SQLite build has no FTS5.")
+        return
+    hits = [hit for hit in store.search(query) if hit["chat_id"] in store.chats]
+    if not hits:
+        st.caption("No matches.")
+    for n, hit in enumerate(hits):
+        name = store.chats[hit["chat_id"]]["name"]
+        label = f"📂 {name}" if hit["message_id"] is None else f"💬 {name} · {hit['role']}"
+        if st.button(label, key=f"hit_{n}_{hit['chat_id']}_{hit['message_id']}", use_container_width=True):
+            open_hit(store, hit["chat_id"], hit["message_id"])
+            st.rerun()
+        st.caption(hit["snippet"])
+
+
+def regenerate_panel(store, **kwargs):
+    # Sidebar "regenerate all": re-asks every prompt of the chosen chats in
+    # parallel and polls progress only while the batch is running
+    batch = st.session_state.get("regen_batch")
+    running = batch is not None and not batch.finished.is_set()
+
+    @st.fragment(run_every=POLL_INTERVAL if running else None)
+    def regenerate():
+        if running and batch.finished.is_set():
+            st.rerun()
+        with st.expander("🔁 Regenerate answers", expanded=running):
+            if running:
+                st.progress(batch.done / batch.total, text=batch.describe())
+                return
+            if batch is not None:
+                st.caption(batch.describe())
+            active = st.session_state.get("active_chat_id")
+            chats = st.multiselect(
+                "Chats",
+                list(store.chats),
+                default=[active] if active in store.chats else [],
+                format_func=lambda cid: store.chats[cid]["name"],
+            )
+            if st.button("Regenerate all", disabled=not chats):
+                st.session_state.regen_batch = shared_dispatcher().regenerate(store, chats, **kwargs)
+                st.rerun()
+
+    regenerate()
+
+
+def transfer_panel(store, chat_id=None):
+    # Sidebar JSONL export/import (see transfer.py). The export is only
+    # built when the download is clicked; Streamlit serves it from memory,
+    # so very large stores are better exported with the CLI. With chat_id,
+    # everything is imported into that chat (X.py's single conversation).
+    with st.expander("⇅ Export / import"):
+        pattern = st.text_input("Chat name contains", key="transfer_name")
+        cols = st.columns(2)
+        since = cols[0].date_input("From", value=None, key="transfer_since")
+        until = cols[1].date_input("To", value=None, key="transfer_until")
+        filters = (
+            since.isoformat() if since else None,
+            until.isoformat() if until else None,
+            pattern.strip() or None,
+        )
+
+        def export():
+            f = tempfile.TemporaryFile("w+", encoding="utf-8")
+            export_jsonl(store, f, *filters)
+            f.seek(0)
+            return f
+
+        st.download_button(
+            "⬇️ Export JSONL", export, file_name="conversations.jsonl", mime="application/jsonl", key="transfer_export"
+        )
+        upload = st.file_uploader("JSONL to import", type=["jsonl"], key="transfer_upload")
+        if upload is not None and st.button("⬆️ Import", key="transfer_import"):
+            # Keyed on the content, so importing the same file again resumes
+            # or adds nothing, while another one of the same name and size
+            # starts from the top
+            digest = hashlib.sha256(upload.getvalue()).hexdigest()
+            chat_name = os.path.splitext(upload.name)[0]
+            read, added = import_jsonl(
+                store, upload, chat_name, *filters, resume_key=f"jsonl_upload:{digest}", chat_id=chat_id
+            )
+            st.session_state.transfer_result = f"Imported {added} of {read} messages from {upload.name}."
+            st.rerun()
+        if "transfer_result" in st.session_state:
+            st.caption(st.session_state.transfer_result)
+
+
+def timings(name):
+    # One row per series of a latency histogram, in ms; app "" is a worker
+    return [
+        {**{k: v or "(worker)" for k, v in labels.items()}, "count": count,
+         "mean ms": mean * 1000, "p50 ms": p50 * 1000, "p95 ms": p95 * 1000, "p99 ms": p99 * 1000}
+        for labels, count, mean, p50, p95, p99 in registry.snapshot(name)
+    ]
+
+
+def job_panel(jobs, cid):
+    # Progress of the chat's background jobs (see job_queue.py), shown while
+    # any are unfinished or failed
+    counts = jobs.store.job_counts(cid)
+    done, failed = counts.get("done", 0), counts.get("failed", 0)
+    total = sum(counts.values())
+    if total == done:
+        return
+    st.progress(
+        (done + failed) / total,
+        text=f"Jobs: {done} done, {counts.get('running', 0)} running, {counts.get('queued', 0)} queued, {failed} failed",
+    )
+    # A full rerun, so the message list is re-read and polling starts again
+    if failed and total == done + failed and st.button(f"🔁 Retry {failed} failed", key=f"retry_jobs_{cid}"):
+        jobs.retry(cid)
+        st.rerun()
+
+
+def debug_panel():
+    # Phase and backend timings of this server process; add ?debug=1 to the
+    # URL. A backend whose circuit breaker is open is always flagged.
+    backends = shared_client().backends()
+    down = [b["endpoint"] for b in backends if b["state"] == "open"]
+    if down:
+        st.warning(f"Backend {', '.join(down)} keeps failing; queries to it fail fast for now.")
+    if not st.query_params.get("debug"):
+        return
+    with st.expander("🩺 Performance"):
+        st.dataframe(timings("chat_phase_seconds"), hide_index=True)
+        backend = timings("chat_backend_seconds")
+        if backend:
+            st.caption("Backend, whole reply")
+            st.dataframe(backend, hide_index=True)
+            st.caption("Backend, first byte")
+            st.dataframe(timings("chat_backend_first_byte_seconds"), hide_index=True)
+        if backends:
+            st.dataframe(backends, hide_index=True)
+        st.caption(shared_client().flights.describe())
+        st.download_button("⬇️ Prometheus metrics", registry.render(), file_name="chat_metrics.prom")
+
+
+def fragment_run():
+    # True while only fragments rerun; False during a full script run,
+    # where st.rerun() from a fragment would drop input not handled yet
+    ctx = get_script_run_ctx()
+    return bool(ctx and ctx.fragment_ids_this_run)
+
+
+def rerun_fragment():
+    # Rerun just the calling fragment; when it is executing as part of a
+    # full script run that is not allowed, so rerun the app instead
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+
+def refresh_messages(store, chat_id, polling=None):
+    # The chat's messages for a message fragment. A fragment-only run skips
+    # open_store and must not reuse the last full run's list: the store drops
+    # it when the chat changes elsewhere. polling is what the full run found
+    # (see poll_pending); when that changes, run_every needs a full rerun.
+    store.refresh()
+    if polling is not None and fragment_run() and poll_pending(store, chat_id) != polling:
+        st.rerun()
+    return store.messages(chat_id)
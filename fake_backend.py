@@ -0,0 +1,142 @@
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stand-in for the /query backend, for benchmarks and load tests:
+#
+#   python fake_backend.py --ports 5000 5002 --latency 0.5 --dist lognormal --stream sse --error-rate 0.02
+#
+# Replies echo the query. Latency is drawn per request from the chosen
+# distribution; streamed replies spread it over --tokens chunks.
+
+PORTS = (5000, 5002)
+DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+STREAMS = ("none", "sse", "ndjson", "text")
+
+
+def sample_latency(rng, dist, mean, spread):
+    # mean is the median for lognormal; spread is its sigma, or the
+    # +/- half-width for uniform
+    if mean <= 0:
+        return 0.0
+    if dist == "uniform":
+        return rng.uniform(max(0.0, mean - spread), mean + spread)
+    if dist == "exponential":
+        return rng.expovariate(1 / mean)
+    if dist == "lognormal":
+        return rng.lognormvariate(math.log(mean), spread)
+    return mean
+
+
+def handler(latency=0.0, dist="fixed", spread=0.0, stream="none", tokens=8, error_rate=0.0, seed=None):
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    class FakeQuery(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            with lock:
+                delay = sample_latency(rng, dist, latency, spread)
+                failed = rng.random() < error_rate
+            if failed:
+                time.sleep(delay)
+                return self.reply(500, "application/json", json.dumps({"error": "injected failure"}).encode())
+            answer = f"Synthetic answer to: {body['query']}"
+            if stream == "none" or not body.get("stream"):
+                time.sleep(delay)
+                return self.reply(200, "application/json", json.dumps({"response": answer}).encode())
+            self.stream(answer, delay)
+
+        def reply(self, status, kind, data):
+            self.send_response(status)
+            self.send_header("Content-Type", kind)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def stream(self, answer, delay):
+            words = answer.split(" ")
+            size = max(1, math.ceil(len(words) / tokens))
+            chunks = [" ".join(words[i:i + size]) + " " for i in range(0, len(words), size)]
+            kind = {"sse": "text/event-stream", "ndjson": "application/x-ndjson", "text": "text/plain"}[stream]
+            self.send_response(200)
+            self.send_header("Content-Type", kind)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in chunks:
+                time.sleep(delay / len(chunks))
+                if stream == "sse":
+                    chunk = f"data: {json.dumps({'token': chunk})}\n\n"
+                elif stream == "ndjson":
+                    chunk = json.dumps({"token": chunk}) + "\n"
+                self.write_chunk(chunk.encode())
+            if stream == "sse":
+                self.write_chunk(b"data: [DONE]\n\n")
+            self.write_chunk(b"")
+
+        def write_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def log_message(self, *args):
+            pass
+
+    return FakeQuery
+
+
+def serve(ports=PORTS, host="127.0.0.1", **options):
+    # One threaded server per port, each on a daemon thread
+    servers = []
+    for port in ports:
+        server = ThreadingHTTPServer((host, port), handler(**options))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.0, help="mean (median for lognormal) seconds per reply")
+    parser.add_argument("--dist", choices=DISTRIBUTIONS, default="fixed", help="latency distribution")
+    parser.add_argument("--spread", type=float, default=0.0, help="lognormal sigma or uniform half-width")
+    parser.add_argument("--stream", choices=STREAMS, default="none", help="reply format for streaming requests")
+    parser.add_argument("--tokens", type=int, default=8, help="chunks per streamed reply")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with HTTP 500")
+
+
+def options(args):
+    return {
+        "latency": args.latency,
+        "dist": args.dist,
+        "spread": args.spread,
+        "stream": args.stream,
+        "tokens": args.tokens,
+        "error_rate": args.error_rate,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fake /query backend")
+    parser.add_argument("--ports", type=int, nargs="+", default=list(PORTS))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--seed", type=int)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    servers = serve(args.ports, host=args.host, seed=args.seed, **options(args))
+    print(f"Fake /query on {', '.join(str(p) for p in args.ports)}; Ctrl-C to stop", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+import streamlit as st
+
+from chat_store import DB_FILE, shared_store
+from query_client import (
+    INTERRUPTED_TEXT,
+    PENDING_TEXT,
+    PREVIEW_INTERVAL,
+    QUERY_URL,
+    QueryStream,
+    shared_cache,
+    shared_client,
+)
+
+# Durable background jobs for long generations (X3.py's configs). Jobs live
+# in the conversation database next to the placeholder their answer goes
+# into, so they survive a server restart: any process with a JobQueue on
+# the file picks up queued jobs, and takes over running ones whose owner
+# stopped renewing its lease.
+JOB_WORKERS = int(os.environ.get("QUERY_JOB_WORKERS", "4"))
+# Seconds between lease renewals, and after which an unrenewed lease is stale
+HEARTBEAT = 5.0
+LEASE = float(os.environ.get("QUERY_JOB_LEASE", "30"))
+# A job taken over this many times is failed rather than run again
+MAX_ATTEMPTS = 3
+# Seconds between looks for jobs queued by other processes
+IDLE_WAIT = 1.0
+
+
+class JobQueue:
+    # One scheduler thread claims jobs while a worker is free and renews
+    # the leases of running ones; workers stream the answer into the
+    # placeholder like QueryDispatcher does.
+
+    def __init__(self, store, client, cache, workers=JOB_WORKERS):
+        self.store = store
+        self.client = client
+        self.cache = cache
+        self.workers = workers
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.cond = threading.Condition()
+        self.running = 0
+        # Jobs submitted here and not yet seen finished, see busy()
+        self.submitted = set()
+        threading.Thread(target=self.schedule, daemon=True, name="job-scheduler").start()
+
+    def submit(self, cid, prompts, after=None, url=QUERY_URL, **kwargs):
+        # Queue one job per prompt, see ChatStore.enqueue_jobs
+        options = json.dumps(dict(kwargs, url=url))
+        jobs = self.store.enqueue_jobs(cid, prompts, PENDING_TEXT, options, after=after)
+        with self.cond:
+            self.submitted.update(jobs)
+            self.cond.notify()
+        return jobs
+
+    def retry(self, cid):
+        jobs = self.store.retry_jobs(cid, PENDING_TEXT)
+        with self.cond:
+            self.submitted.update(jobs)
+            self.cond.notify()
+        return jobs
+
+    def schedule(self):
+        renewed = 0.0
+        while True:
+            try:
+                if self.running and time.monotonic() - renewed >= HEARTBEAT:
+                    self.store.renew_jobs(self.owner)
+                    renewed = time.monotonic()
+                job = self.store.claim_job(self.owner, LEASE) if self.running < self.workers else None
+            except Exception:
+                # e.g. the database is locked for longer than its timeout
+                job = None
+            if job is not None:
+                with self.cond:
+                    self.running += 1
+                self.pool.submit(self.run, job)
+                continue
+            with self.cond:
+                self.cond.wait(IDLE_WAIT)
+
+    def run(self, job):
+        jid, cid, mid, prompt, options, attempts = job
+        try:
+            if attempts >= MAX_ATTEMPTS:
+                # Its workers kept dying, it would probably kill this one too
+                self.store.resolve_pending(cid, mid, jid, INTERRUPTED_TEXT, failed=True)
+                return
+            kwargs = json.loads(options)
+            reply = QueryStream(prompt, client=self.client, cache=self.cache, **kwargs)
+            partial = ""
+            last_preview = time.monotonic()
+            for token in reply:
+                if isinstance(token, str):
+                    partial += token
+                if time.monotonic() - last_preview >= PREVIEW_INTERVAL:
+                    self.store.preview_pending(cid, mid, jid, partial)
+                    last_preview = time.monotonic()
+            self.store.resolve_pending(cid, mid, jid, reply.answer, failed=reply.failed)
+        except Exception as e:
+            self.store.resolve_pending(cid, mid, jid, f"Error: {e}", failed=True)
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.cond.notify()
+
+    def busy(self):
+        # True while a job submitted through this queue is unfinished
+        with self.cond:
+            jobs = set(self.submitted)
+        active = self.store.active_jobs(jobs)
+        with self.cond:
+            self.submitted -= jobs - active
+        return bool(active)
+
+
+@st.cache_resource(show_spinner=False)
+def shared_jobs(path=DB_FILE):
+    return JobQueue(shared_store(path), shared_client(), shared_cache())
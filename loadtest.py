@@ -0,0 +1,294 @@
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from uuid import uuid4
+
+import fake_backend
+from chat_store import ChatStore
+from query_client import INTERRUPTED_TEXT
+
+# Load test: N simulated operators hammering one app at the same time.
+#
+#   python loadtest.py --app X4.py --sessions 16 --iterations 5 --latency 0.3 --dist lognormal --spread 0.5
+#
+# Every session is its own process driving the app through AppTest (which
+# is not thread-safe), so all sessions write the same conversations.db the
+# way several server processes would. Each iteration is
+# create chat -> send A -> send B -> edit A -> delete B, waiting for the
+# assistant after every send/edit. At the end the database is checked
+# against what each session expects to survive; mismatches are lost
+# updates. Runs offline against fake_backend on ports 5000 and 5002.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APPS = ["X2.py", "X3.py", "X4.py", "X5.py", "x5,py"]
+DATA_FILE = "conversations.db"
+INTERACTIONS = ["first_load", "create", "send", "reply", "edit", "delete"]
+# Answers the frontends store when the backend failed
+FAILED_PREFIXES = ("Error", "No response from server.")
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+class Session:
+    # One simulated operator. `expect` maps every text this session wrote
+    # to whether it must still be in the database at the end.
+
+    def __init__(self, app, number, timeout, reply_timeout):
+        from streamlit.testing.v1 import AppTest
+
+        path = os.path.join(HERE, app)
+        if not app.endswith(".py"):
+            # AppTest wants a .py file name, x5,py does not have one
+            path = os.path.abspath(f"session{number}.py")
+            shutil.copy(os.path.join(HERE, app), path)
+        self.app = app
+        self.number = number
+        self.reply_timeout = reply_timeout
+        self.at = AppTest.from_file(path, default_timeout=timeout)
+        # Separate connection for looking up message ids, like a second tab
+        self.store = ChatStore(DATA_FILE)
+        self.cid = None
+        self.samples = []
+        self.expect = {}
+        self.errors = []
+
+    def timed(self, name, fn, *args):
+        start = time.perf_counter()
+        ok = True
+        try:
+            fn(*args)
+        except Exception as e:
+            ok = False
+            self.errors.append(f"{name}: {e!r}")
+        if self.at.exception:
+            ok = False
+            self.errors.append(f"{name}: {self.at.exception[0].value}")
+        self.samples.append((name, time.perf_counter() - start, ok))
+        return ok
+
+    def unique(self, label):
+        return f"load s{self.number} {label} {uuid4().hex[:8]}"
+
+    def find(self, text):
+        self.store.refresh()
+        for msg in self.store.messages(self.cid):
+            if msg["content"] == text:
+                return msg["id"]
+        raise LookupError(f"message {text!r} not in chat")
+
+    def show(self, mid):
+        # Widen the window like "load earlier" so the message has its buttons
+        total = len(self.store.messages(self.cid))
+        self.at.session_state[f"window_{self.cid}"] = max(20, total - self.store.index_of(self.cid, mid) + 10)
+
+    def first_load(self, cid):
+        self.at.run()
+        if cid is not None:
+            self.at.session_state.active_chat_id = cid
+            self.at.run()
+            self.cid = cid
+
+    def create(self):
+        [b for b in self.at.sidebar.button if "New" in b.label][0].click().run()
+        self.cid = self.at.session_state.active_chat_id
+
+    def send(self, text):
+        self.expect[text] = True
+        if self.at.chat_input:
+            self.at.chat_input[0].set_value(text).run()
+        else:
+            self.at.text_area(key="main_input").set_value(text)
+            [b for b in self.at.button if b.label == "Submit"][0].click().run()
+
+    def reply(self):
+        # Replies run on this process's dispatcher threads, X3.py's as
+        # durable jobs that any session's process may pick up
+        from job_queue import shared_jobs
+        from query_client import shared_dispatcher
+
+        dispatcher = shared_dispatcher()
+        jobs = shared_jobs(DATA_FILE) if self.app == "X3.py" else None
+        deadline = time.monotonic() + self.reply_timeout
+        while dispatcher.jobs or (jobs is not None and jobs.busy()):
+            if time.monotonic() > deadline:
+                raise TimeoutError("no reply from the assistant")
+            time.sleep(0.01)
+
+    def edit(self, old, new):
+        mid = self.find(old)
+        self.show(mid)
+        if self.app == "x5,py":
+            # Its edit button is HTML that posts edit_msg_id from JavaScript
+            self.at.session_state.edit_msg_id = mid
+            self.at.run()
+        else:
+            self.at.button(key=f"editbtn_{mid}").click().run()
+        self.at.text_area(key=f"edit_{mid}").set_value(new)
+        save = [b for b in self.at.button if b.key in (f"resend_{mid}", f"save_{mid}")]
+        save[0].click().run()
+        self.expect[old] = False
+        self.expect[new] = True
+
+    def delete(self, text):
+        mid = self.find(text)
+        self.show(mid)
+        self.at.button(key=f"delbtn_{mid}").click().run()
+        self.expect[text] = False
+
+    def iteration(self, shared):
+        if not shared and not self.timed("create", self.create):
+            return
+        a, b = self.unique("a"), self.unique("b")
+        for text in (a, b):
+            if self.timed("send", self.send, text):
+                self.timed("reply", self.reply)
+        if self.timed("edit", self.edit, a, self.unique("a edited")):
+            self.timed("reply", self.reply)
+        if self.app != "x5,py":
+            self.timed("delete", self.delete, b)
+
+
+def run_session(app, number, args, workdir, barrier, shared_cid):
+    os.chdir(workdir)
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    session = Session(app, number, args.timeout, args.reply_timeout)
+    barrier.wait()
+    started = time.time()
+    session.timed("first_load", session.first_load, shared_cid)
+    for _ in range(args.iterations):
+        session.iteration(shared_cid is not None)
+    return {
+        "started": started,
+        "finished": time.time(),
+        "samples": session.samples,
+        "expect": session.expect,
+        "errors": session.errors,
+    }
+
+
+def check_store(path, results):
+    # Lost updates: texts that should survive but are gone, or were
+    # edited/deleted away but are still there
+    store = ChatStore(path)
+    texts = Counter()
+    stuck = interrupted = failed = 0
+    for cid in store.chats:
+        for msg in store.messages(cid):
+            content = msg["content"]
+            if "pending" in msg:
+                stuck += 1
+            elif content == INTERRUPTED_TEXT:
+                # Closed by a poller while a worker was still on it: a bug
+                # unless a server process really died
+                interrupted += 1
+            elif msg["role"] == "assistant" and isinstance(content, str) and content.startswith(FAILED_PREFIXES):
+                failed += 1
+            if isinstance(content, str):
+                texts[content] += 1
+    lost = sum(
+        1
+        for result in results
+        for text, present in result["expect"].items()
+        if (texts[text] > 0) != present
+    )
+    store.conn.close()
+    return {"lost_updates": lost, "stuck_replies": stuck, "interrupted_replies": interrupted, "failed_replies": failed}
+
+
+def report(args, results, check):
+    samples = [sample for result in results for sample in result["samples"]]
+    elapsed = max(r["finished"] for r in results) - min(r["started"] for r in results)
+    actions = [s for s in samples if s[0] != "reply"]
+    summary = {
+        "app": args.app,
+        "sessions": args.sessions,
+        "iterations": args.iterations,
+        "shared_chat": args.shared_chat,
+        "backend": fake_backend.options(args),
+        "elapsed_s": elapsed,
+        "interactions": len(actions),
+        "throughput_per_s": len(actions) / elapsed if elapsed else 0.0,
+        "errors": sum(1 for s in samples if not s[2]),
+        **check,
+        "latency_ms": {},
+    }
+    for name in INTERACTIONS:
+        values = [s[1] for s in samples if s[0] == name and s[2]]
+        if values:
+            summary["latency_ms"][name] = {
+                "count": len(values),
+                "p50": percentile(values, 0.50) * 1000,
+                "p95": percentile(values, 0.95) * 1000,
+                "p99": percentile(values, 0.99) * 1000,
+            }
+    return summary
+
+
+def print_summary(summary, errors):
+    print(f"{summary['app']}: {summary['sessions']} sessions x {summary['iterations']} iterations "
+          f"in {summary['elapsed_s']:.1f}s, {summary['throughput_per_s']:.1f} interactions/s")
+    print(f"{'interaction':<12}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, row in summary["latency_ms"].items():
+        print(f"{name:<12}{row['count']:>7}{row['p50']:>10.1f}{row['p95']:>10.1f}{row['p99']:>10.1f}")
+    print(f"errors {summary['errors']}, lost updates {summary['lost_updates']}, "
+          f"stuck replies {summary['stuck_replies']}, interrupted replies {summary['interrupted_replies']}, "
+          f"failed replies {summary['failed_replies']}")
+    for error in errors[:10]:
+        print("  " + error)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for the chat frontends")
+    parser.add_argument("--app", choices=APPS, default="X4.py")
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent simulated operators")
+    parser.add_argument("--iterations", type=int, default=3, help="create/send/edit/delete rounds per session")
+    parser.add_argument("--shared-chat", action="store_true", help="all sessions work in one conversation")
+    parser.add_argument("--timeout", type=float, default=120.0, help="AppTest timeout per rerun")
+    parser.add_argument("--reply-timeout", type=float, default=120.0, help="seconds to wait for an answer")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="also write the JSON summary to this file")
+    fake_backend.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    servers = fake_backend.serve(seed=args.seed, **fake_backend.options(args))
+    workdir = tempfile.mkdtemp(prefix="chat-load-")
+    path = os.path.join(workdir, DATA_FILE)
+    shared_cid = None
+    store = ChatStore(path)
+    if args.shared_chat:
+        shared_cid = store.create_chat("Load test")
+    store.conn.close()
+    try:
+        context = multiprocessing.get_context("spawn")
+        with context.Manager() as manager, context.Pool(args.sessions) as pool:
+            barrier = manager.Barrier(args.sessions)
+            results = pool.starmap(
+                run_session,
+                [(args.app, n, args, workdir, barrier, shared_cid) for n in range(args.sessions)],
+            )
+        summary = report(args, results, check_store(path, results))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        for server in servers:
+            server.shutdown()
+    print_summary(summary, [e for r in results for e in r["errors"]])
+    print(json.dumps(summary))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary["errors"] == 0 and summary["lost_updates"] == 0 and summary["interrupted_replies"] == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
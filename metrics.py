@@ -0,0 +1,200 @@
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# Prometheus text export: rewritten every FLUSH_INTERVAL seconds to
+# CHAT_METRICS_FILE and/or served on http://localhost:CHAT_METRICS_PORT/metrics
+METRICS_FILE = os.environ.get("CHAT_METRICS_FILE")
+METRICS_PORT = int(os.environ.get("CHAT_METRICS_PORT", "0"))
+FLUSH_INTERVAL = 10.0
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# name -> (help, buckets)
+HISTOGRAMS = {
+    "chat_phase_seconds": ("Time spent in each phase of a rerun, by app and phase", TIME_BUCKETS),
+    "chat_backend_seconds": ("Backend /query latency until the reply was consumed, by endpoint", TIME_BUCKETS),
+    "chat_backend_first_byte_seconds": ("Backend /query latency until the response headers arrived, by endpoint", TIME_BUCKETS),
+    "chat_backend_request_bytes": ("Backend /query request payload size, by endpoint", SIZE_BUCKETS),
+    "chat_backend_response_bytes": ("Backend /query response size, by endpoint", SIZE_BUCKETS),
+}
+
+
+def current_app():
+    # Script file of the session doing the work; "" on worker threads
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return os.path.basename(ctx.main_script_path) if ctx is not None else ""
+
+
+def endpoint_label(url):
+    # http://localhost:5002/query -> ":5002/query"
+    parts = urlsplit(url)
+    return f":{parts.port or ''}{parts.path}"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # counts[i] observations <= buckets[i] (and > buckets[i-1]); last is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Linear interpolation inside the bucket, like histogram_quantile()
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Registry:
+    # Process-wide histograms. Plain module state rather than
+    # st.cache_resource: the store and dispatcher observe from worker
+    # threads that have no script run context.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}
+        self.flushed = 0.0
+        self.server = None
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.series.get(key)
+            if histogram is None:
+                histogram = self.series[key] = Histogram(HISTOGRAMS[name][1])
+            histogram.observe(value)
+        if METRICS_FILE and time.monotonic() - self.flushed >= FLUSH_INTERVAL:
+            self.flush(METRICS_FILE)
+
+    @contextmanager
+    def span(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("chat_phase_seconds", time.perf_counter() - start, app=current_app(), phase=phase)
+
+    def snapshot(self, name):
+        # [(labels dict, count, mean, p50, p95, p99)] for the debug panel
+        with self.lock:
+            rows = []
+            for (series, labels), h in sorted(self.series.items()):
+                if series == name:
+                    rows.append(
+                        (dict(labels), h.count, h.sum / h.count, h.quantile(0.5), h.quantile(0.95), h.quantile(0.99))
+                    )
+            return rows
+
+    def quantile(self, name, q, **labels):
+        # (count, q-quantile) of one series; (0, 0.0) before any observation
+        with self.lock:
+            h = self.series.get((name, tuple(sorted(labels.items()))))
+            return (h.count, h.quantile(q)) if h is not None else (0, 0.0)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (help_text, buckets) in HISTOGRAMS.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for (series, labels), h in sorted(self.series.items()):
+                    if series != name:
+                        continue
+                    tags = ",".join(f'{k}="{v}"' for k, v in labels)
+                    prefix = tags + "," if tags else ""
+                    cumulative = 0
+                    for bound, n in zip(list(buckets) + ["+Inf"], h.counts):
+                        cumulative += n
+                        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                    lines.append(f"{name}_sum{{{tags}}} {h.sum}")
+                    lines.append(f"{name}_count{{{tags}}} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def flush(self, path):
+        # Atomic rewrite so a scraper never reads half a file
+        self.flushed = time.monotonic()
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200 if self.path.split("?")[0] == "/metrics" else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="metrics").start()
+
+
+registry = Registry()
+if METRICS_PORT:
+    try:
+        registry.serve(METRICS_PORT)
+    except OSError:
+        # Another server process already exports on this port
+        pass
+
+
+def span(phase):
+    return registry.span(phase)
+
+
+def traced(phase):
+    # Decorator form of span(), for fragments that rerun on their own
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with registry.span(phase):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def observe_first_byte(url, seconds):
+    registry.observe("chat_backend_first_byte_seconds", seconds, endpoint=endpoint_label(url))
+
+
+def observe_backend(url, seconds, request_bytes, response_bytes):
+    endpoint = endpoint_label(url)
+    registry.observe("chat_backend_seconds", seconds, endpoint=endpoint)
+    registry.observe("chat_backend_request_bytes", request_bytes, endpoint=endpoint)
+    if response_bytes is not None:
+        registry.observe("chat_backend_response_bytes", response_bytes, endpoint=endpoint)
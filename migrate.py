@@ -0,0 +1,64 @@
+import argparse
+import glob
+import os
+import sys
+import time
+
+from chat_store import ChatStore
+
+# One-shot migration of the legacy pickles into the SQLite store:
+#
+#   python migrate.py conversations.pkl            # -> conversations.db
+#   python migrate.py chat_history.pkl             # -> chat_history.db (X.py)
+#   python migrate.py --recompress conversations.db
+#   python migrate.py --pack-blobs conversations.db
+#
+# Pickles are read with a restricted unpickler and written one chat per
+# transaction; chats already in the store are skipped, so an interrupted
+# run can be repeated. --recompress rewrites rows from before the binary
+# message format and moves large inline bodies to the blob file.
+# --pack-blobs drops edited and deleted bodies from the blob file; run it
+# with the app stopped.
+
+
+def size(path):
+    # The database plus its WAL and blob files, in MiB
+    stem = os.path.splitext(path)[0]
+    files = [path, path + "-wal"] + glob.glob(glob.escape(stem) + ".*.blobs")
+    return sum(os.path.getsize(p) for p in files if os.path.exists(p)) / 2**20
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate legacy chat pickles into the SQLite store")
+    parser.add_argument("source", help="pickle to import, or the database with --recompress/--pack-blobs")
+    parser.add_argument("--db", help="target database (default: the pickle name with .db)")
+    parser.add_argument("--recompress", action="store_true", help="convert JSON text rows to the binary format")
+    parser.add_argument("--pack-blobs", action="store_true", help="reclaim blob file space (app stopped)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    if args.pack_blobs:
+        store = ChatStore(args.source, legacy_file="")
+        reclaimed = store.pack_blobs()
+        print(f"Reclaimed {reclaimed / 2**20:.1f} MiB in {time.perf_counter() - start:.1f}s, {size(args.source):.1f} MiB")
+        return 0
+    if args.recompress:
+        store = ChatStore(args.source, legacy_file="")
+        converted = store.recompress()
+        print(f"Converted {converted} messages in {time.perf_counter() - start:.1f}s, {size(args.source):.1f} MiB")
+        return 0
+
+    db = args.db or os.path.splitext(args.source)[0] + ".db"
+    # Import explicitly below rather than on open, to report what was done
+    store = ChatStore(db, legacy_file="")
+    chats, messages = store.import_pickle(args.source)
+    store.compact()
+    print(
+        f"Imported {chats} chats, {messages} messages in {time.perf_counter() - start:.1f}s: "
+        f"{os.path.getsize(args.source) / 2**20:.1f} MiB pickle -> {size(db):.1f} MiB {db}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1002 @@
+import hashlib
+import json
+import os
+import queue
+import random
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from uuid import uuid4
+
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+
+from metrics import endpoint_label, observe_backend, observe_first_byte, registry
+
+QUERY_URL = "http://localhost:5002/query"
+
+CONNECT_TIMEOUT = float(os.environ.get("QUERY_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("QUERY_READ_TIMEOUT", "120"))
+# Budget for a whole query, reading a streamed reply included
+DEADLINE = float(os.environ.get("QUERY_DEADLINE", "120"))
+# Interchangeable backends, comma-separated. A query to one of them fails
+# over to the next; with hedging on it is also sent to the next when the
+# first has not answered within its p95 time to first byte (HEDGE_DELAY
+# until HEDGE_MIN_SAMPLES replies have been timed).
+REPLICAS = [url.strip() for url in os.environ.get("QUERY_REPLICAS", "").split(",") if url.strip()]
+HEDGE = os.environ.get("QUERY_HEDGE", "1") != "0"
+HEDGE_DELAY = float(os.environ.get("QUERY_HEDGE_DELAY", "1"))
+HEDGE_MIN_SAMPLES = 20
+# After this many failures in a row a backend is skipped for the cooldown
+BREAKER_FAILURES = int(os.environ.get("QUERY_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.environ.get("QUERY_BREAKER_COOLDOWN", "30"))
+# Upper bound on requests in flight from this server process
+MAX_CONCURRENCY = int(os.environ.get("QUERY_MAX_CONCURRENCY", "8"))
+# Workers re-asking prompts for "regenerate all"; they share the slots above
+BATCH_CONCURRENCY = int(os.environ.get("QUERY_BATCH_CONCURRENCY", str(MAX_CONCURRENCY)))
+# Longest a caller follows an identical query already in flight
+FLIGHT_TIMEOUT = float(os.environ.get("QUERY_FLIGHT_TIMEOUT", str(DEADLINE)))
+
+# Response cache: in-memory LRU plus an optional on-disk tier (QUERY_CACHE_FILE)
+CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "256"))
+CACHE_TTL = float(os.environ.get("QUERY_CACHE_TTL", "3600"))
+CACHE_FILE = os.environ.get("QUERY_CACHE_FILE")
+CACHE_DISK_SIZE = int(os.environ.get("QUERY_CACHE_DISK_SIZE", "10000"))
+# Near-duplicate prompts (see SimilarPrompts), off by default since a match
+# is not the same question. QUERY_SIMILAR=suggest offers the earlier answer
+# to the operator, who can use it or ask anyway; QUERY_SIMILAR=serve returns
+# it in place of asking the backend, for interactive queries only.
+SIMILAR_MODE = os.environ.get("QUERY_SIMILAR", "off")
+SIMILAR_THRESHOLD = float(os.environ.get("QUERY_SIMILAR_THRESHOLD", "0.8"))
+SIMILAR_SIZE = int(os.environ.get("QUERY_SIMILAR_SIZE", "2000"))
+SIMILAR_BYTES = int(os.environ.get("QUERY_SIMILAR_BYTES", str(32 * 2**20)))
+# MinHash signature: PERMUTATIONS values of character SHINGLE-grams, split
+# into BANDS for the LSH table. Pairs above ~0.5 Jaccard share a band.
+SHINGLE = 3
+PERMUTATIONS = 64
+BANDS = 16
+MERSENNE = (1 << 61) - 1
+
+PENDING_TEXT = "⏳ Waiting for the assistant..."
+INTERRUPTED_TEXT = "Error: the request was interrupted before the backend answered."
+# Seconds between UI polls while a reply is pending, and between partial-answer previews
+POLL_INTERVAL = 1.0
+PREVIEW_INTERVAL = 0.25
+# Seconds between lease renewals of in-flight placeholders, and after which
+# a placeholder whose process stopped renewing counts as interrupted
+LEASE_HEARTBEAT = 5.0
+LEASE = float(os.environ.get("QUERY_LEASE", "30"))
+
+STREAM_ACCEPT = "text/event-stream, application/x-ndjson, text/plain, application/json"
+
+
+def token_from(payload):
+    # SSE/NDJSON events may carry bare strings or {"token"|"response"|"text": ...}
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return payload
+    if isinstance(data, dict):
+        return data.get("token") or data.get("response") or data.get("text") or ""
+    return data if isinstance(data, str) else str(data)
+
+
+def iter_tokens(res, kind):
+    if kind == "text/event-stream":
+        for line in res.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            payload = line[5:].removeprefix(" ")
+            if payload == "[DONE]":
+                break
+            yield token_from(payload)
+    elif kind == "application/x-ndjson":
+        for line in res.iter_lines(decode_unicode=True):
+            if line:
+                yield token_from(line)
+    else:
+        res.encoding = res.encoding or "utf-8"
+        yield from res.iter_content(chunk_size=None, decode_unicode=True)
+
+
+def received_bytes(res):
+    # Bytes read off the wire so far, streamed or not
+    try:
+        return res.raw.tell()
+    except Exception:
+        return None
+
+
+class Flight:
+    # One backend request shared by every caller asking the same question
+    # at the same time. The request publishes tokens as they arrive; each
+    # follower replays them from the start.
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.tokens = []
+        self.done = False
+        self.answer = None
+        self.error = None
+        self.waiters = 0
+        self.cancelled = False
+        # Open response, closed to cancel the request
+        self.res = None
+
+    def publish(self, token):
+        with self.cond:
+            self.tokens.append(token)
+            self.cond.notify_all()
+
+    def finish(self, answer=None, error=None):
+        with self.cond:
+            if not self.done:
+                self.answer, self.error, self.done = answer, error, True
+                self.cond.notify_all()
+
+    def follow(self, timeout):
+        # Tokens so far, then the rest as they arrive, until the request is
+        # done; TimeoutError if it is not done within timeout seconds
+        deadline = time.monotonic() + timeout
+        seen = 0
+        while True:
+            with self.cond:
+                while seen == len(self.tokens) and not self.done:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"the identical query in flight took longer than {timeout:g}s")
+                    self.cond.wait(remaining)
+                tokens = self.tokens[seen:]
+                seen += len(tokens)
+                done = self.done
+            yield from tokens
+            if done:
+                return
+
+
+class SingleFlight:
+    # Process-wide table of queries in flight, keyed on (endpoint,
+    # normalized query). A caller asking what is already being asked
+    # follows that request instead of sending its own. Requests run on
+    # their own workers, so one outlives the session that started it, and
+    # are cancelled when every follower has left.
+
+    def __init__(self, max_workers=MAX_CONCURRENCY, timeout=FLIGHT_TIMEOUT):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="flight")
+        self.timeout = timeout
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.started = self.joined = self.cancelled = 0
+
+    @contextmanager
+    def join(self, key, fetch):
+        # fetch(flight) sends the request, publishing into flight
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = Flight()
+                self.started += 1
+                self.pool.submit(self.run, key, flight, fetch)
+            else:
+                self.joined += 1
+            flight.waiters += 1
+        try:
+            yield flight
+        finally:
+            self.leave(key, flight)
+
+    def run(self, key, flight, fetch):
+        try:
+            if not flight.cancelled:
+                fetch(flight)
+        except Exception as e:
+            flight.finish(error=e)
+        finally:
+            flight.finish(error=RuntimeError("the query was cancelled"))
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+
+    def leave(self, key, flight):
+        with self.lock:
+            flight.waiters -= 1
+            if flight.waiters or flight.done:
+                return
+            # Nobody is waiting for the answer any more
+            flight.cancelled = True
+            self.cancelled += 1
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            res = flight.res
+        if res is not None:
+            res.close()
+
+    def describe(self):
+        with self.lock:
+            return (
+                f"Backend queries: {len(self.flights)} in flight, {self.started} sent, "
+                f"{self.joined} coalesced, {self.cancelled} cancelled"
+            )
+
+
+class Breaker:
+    # Circuit breaker for one backend. After `failures` failed calls in a
+    # row it opens and calls fail fast; once `cooldown` seconds have passed
+    # a single trial call decides whether it closes again.
+
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failed = 0
+        self.opened_at = None
+        self.trial = False
+
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        with self.lock:
+            state = self.state()
+            if state == "half-open" and not self.trial:
+                self.trial = True
+                return True
+            return state == "closed"
+
+    def release(self):
+        # An allowed call that was never sent
+        with self.lock:
+            self.trial = False
+
+    def record(self, ok):
+        with self.lock:
+            self.trial = False
+            if ok:
+                self.failed = 0
+                self.opened_at = None
+                return
+            self.failed += 1
+            if self.opened_at is not None or self.failed >= self.failures:
+                self.opened_at = time.monotonic()
+
+    def retry_in(self):
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic()) if self.opened_at is not None else 0.0
+
+
+class QueryClient:
+    # Keep-alive connection pool shared by every session of the process.
+    # A semaphore caps concurrent backend calls; callers wait for a free
+    # slot until their deadline instead of piling more load on the backend.
+    # Every backend has a circuit breaker; replicas take over from each
+    # other (see REPLICAS). Streamed queries go through the flights table
+    # (see SingleFlight).
+
+    def __init__(
+        self,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        max_concurrency=MAX_CONCURRENCY,
+        deadline=DEADLINE,
+        replicas=REPLICAS,
+        hedge=HEDGE,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.deadline = deadline
+        self.replicas = list(replicas)
+        self.hedge = hedge
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.flights = SingleFlight(max_workers=max_concurrency)
+        self.breakers = {}
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_concurrency, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def breaker(self, url):
+        with self.lock:
+            breaker = self.breakers.get(url)
+            if breaker is None:
+                breaker = self.breakers[url] = Breaker()
+            return breaker
+
+    def candidates(self, url):
+        # url first, then the other replicas in configured order
+        if url not in self.replicas:
+            return [url]
+        return [url] + [u for u in self.replicas if u != url]
+
+    def hedge_delay(self, url):
+        count, p95 = registry.quantile("chat_backend_first_byte_seconds", 0.95, endpoint=endpoint_label(url))
+        return p95 if count >= HEDGE_MIN_SAMPLES else HEDGE_DELAY
+
+    @contextmanager
+    def post(self, url, payload, deadline=None, **kwargs):
+        # Reply to payload from url or one of its replicas. Reading the
+        # reply must also end before deadline (time.monotonic() value,
+        # default self.deadline from now); past it the reply is closed and
+        # TimeoutError raised.
+        deadline = deadline or time.monotonic() + self.deadline
+        start = time.perf_counter()
+        expired = threading.Event()
+        res = timer = None
+
+        def expire():
+            expired.set()
+            res.close()
+
+        try:
+            url, res = self.send(url, payload, deadline, **kwargs)
+            timer = threading.Timer(max(0.0, deadline - time.monotonic()), expire)
+            timer.daemon = True
+            timer.start()
+            with res:
+                yield res
+        except Exception as e:
+            if expired.is_set():
+                raise TimeoutError(f"no complete answer within {self.deadline:g}s") from e
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if res is not None:
+                self.slots.release()
+            observe_backend(url, time.perf_counter() - start, len(json.dumps(payload)), received_bytes(res))
+        # A closed stream can also just end early
+        if expired.is_set():
+            raise TimeoutError(f"no complete answer within {self.deadline:g}s")
+
+    def send(self, url, payload, deadline, **kwargs):
+        # (url, response) from the first candidate backend to answer. The
+        # next one is tried when a call fails or its breaker is open, and
+        # with hedging also when a call is slower than its hedge delay.
+        # Returns holding one slot, released by post().
+        waiting = self.candidates(url)
+        results = queue.Queue()
+        lock = threading.Lock()
+        settled = threading.Event()
+
+        def attempt(u):
+            try:
+                res = self.attempt(u, payload, deadline, **kwargs)
+            except Exception as e:
+                self.slots.release()
+                results.put((u, None, e))
+                return
+            with lock:
+                if not settled.is_set():
+                    results.put((u, res, None))
+                    return
+            # Another call won the race
+            res.close()
+            self.slots.release()
+
+        def settle(keep=None):
+            with lock:
+                settled.set()
+            while not results.empty():
+                u, res, e = results.get()
+                if res is not None and res is not keep:
+                    res.close()
+                    self.slots.release()
+
+        pending = 0
+        hedge_at = None
+        error = fallback = None
+        while True:
+            now = time.monotonic()
+            if waiting and (not pending or (self.hedge and now >= hedge_at)):
+                u = waiting.pop(0)
+                breaker = self.breaker(u)
+                if not breaker.allow():
+                    error = error or ConnectionError(
+                        f"{endpoint_label(u)} failed {breaker.failed} times in a row, "
+                        f"not retried for {breaker.retry_in():.0f}s"
+                    )
+                    continue
+                if pending:
+                    # Hedges only use spare slots
+                    acquired = self.slots.acquire(blocking=False)
+                else:
+                    acquired = self.slots.acquire(timeout=max(0.0, deadline - now))
+                if not acquired:
+                    breaker.release()
+                    if not pending:
+                        raise TimeoutError("too many queries in flight, gave up waiting for a free slot")
+                    waiting = []
+                    continue
+                pending += 1
+                hedge_at = now + self.hedge_delay(u)
+                threading.Thread(target=attempt, args=(u,), daemon=True, name="query-attempt").start()
+                continue
+            if not pending:
+                # Every candidate failed or is shut off by its breaker
+                if fallback is not None:
+                    return fallback
+                raise error
+            timeout = deadline - now
+            if waiting and self.hedge:
+                timeout = min(timeout, hedge_at - now)
+            try:
+                u, res, e = results.get(timeout=max(0.0, timeout))
+            except queue.Empty:
+                if time.monotonic() >= deadline:
+                    settle(fallback and fallback[1])
+                    if fallback is not None:
+                        return fallback
+                    raise TimeoutError(f"no answer within {self.deadline:g}s") from None
+                continue
+            pending -= 1
+            if e is not None:
+                error = e
+            elif res.status_code < 500:
+                settle(res)
+                if fallback is not None:
+                    fallback[1].close()
+                    self.slots.release()
+                return u, res
+            elif fallback is None:
+                # Server error: kept as the answer unless another replica does better
+                fallback = (u, res)
+            else:
+                res.close()
+                self.slots.release()
+
+    def attempt(self, url, payload, deadline, **kwargs):
+        # One call to one backend, once the response headers are in
+        breaker = self.breaker(url)
+        remaining = deadline - time.monotonic()
+        start = time.perf_counter()
+        try:
+            if remaining <= 0:
+                raise TimeoutError(f"no answer within {self.deadline:g}s")
+            res = self.session.post(
+                url,
+                json=payload,
+                timeout=(min(self.timeout[0], remaining), min(self.timeout[1], remaining)),
+                **kwargs,
+            )
+        except Exception:
+            breaker.record(False)
+            raise
+        breaker.record(res.status_code < 500)
+        observe_first_byte(url, time.perf_counter() - start)
+        return res
+
+    def backends(self):
+        # [{endpoint, state, failures, hedge ms}] for the debug panel
+        with self.lock:
+            breakers = dict(self.breakers)
+        urls = list(dict.fromkeys(self.replicas + list(breakers)))
+        return [
+            {
+                "endpoint": endpoint_label(url),
+                "state": breakers[url].state() if url in breakers else "closed",
+                "failures": breakers[url].failed if url in breakers else 0,
+                "hedge after ms": self.hedge_delay(url) * 1000 if self.hedge and url in self.replicas else None,
+            }
+            for url in urls
+        ]
+
+
+@st.cache_resource(show_spinner=False)
+def shared_client():
+    return QueryClient()
+
+
+def normalize_query(prompt):
+    return " ".join(prompt.split()).casefold()
+
+
+def hash_functions(seed=0):
+    # (a, b) of the hashes (a * x + b) mod MERSENNE; seeded, so every
+    # process computes the same signatures
+    rng = random.Random(seed)
+    return [(rng.randrange(1, MERSENNE), rng.randrange(MERSENNE)) for _ in range(PERMUTATIONS)]
+
+
+HASHES = hash_functions()
+
+
+def minhash(text):
+    # Signature of the normalized text; the fraction of positions two
+    # signatures agree on estimates the Jaccard similarity of their shingles
+    text = normalize_query(text)
+    shingles = {zlib.crc32(text[i:i + SHINGLE].encode()) for i in range(max(1, len(text) - SHINGLE + 1))}
+    return tuple(min((a * x + b) % MERSENNE for x in shingles) for a, b in HASHES)
+
+
+def answer_size(answer):
+    return len(answer) if isinstance(answer, str) else len(json.dumps(answer))
+
+
+class SimilarPrompts:
+    # Earlier answers found by prompt similarity rather than equality, so
+    # "...for a 5G RAN node" can reuse "...for 5G RAN nodes". A MinHash LSH
+    # table: every entry sits in one bucket per band of its signature, and
+    # a lookup scores only the entries sharing a bucket with the prompt.
+    # Least recently used entries go first once max_entries or max_bytes
+    # of answers are exceeded; entries expire after ttl seconds.
+
+    def __init__(
+        self,
+        threshold=SIMILAR_THRESHOLD,
+        max_entries=SIMILAR_SIZE,
+        max_bytes=SIMILAR_BYTES,
+        ttl=CACHE_TTL,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # (endpoint, normalized prompt) -> (stored_at, prompt, answer, signature, size)
+        self.entries = OrderedDict()
+        # (endpoint, band, band values) -> keys of the entries in the bucket
+        self.buckets = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.reused = 0
+
+    def bands(self, endpoint, signature):
+        rows = PERMUTATIONS // BANDS
+        return [(endpoint, band, signature[band * rows:(band + 1) * rows]) for band in range(BANDS)]
+
+    def add(self, endpoint, prompt, answer):
+        key = (endpoint, normalize_query(prompt))
+        signature = minhash(prompt)
+        size = answer_size(answer)
+        with self.lock:
+            self.drop(key)
+            self.entries[key] = (time.time(), prompt, answer, signature, size)
+            self.bytes += size
+            for bucket in self.bands(endpoint, signature):
+                self.buckets.setdefault(bucket, set()).add(key)
+            while len(self.entries) > self.max_entries or (self.bytes > self.max_bytes and len(self.entries) > 1):
+                self.drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry[4]
+        for bucket in self.bands(key[0], entry[3]):
+            keys = self.buckets[bucket]
+            keys.discard(key)
+            if not keys:
+                del self.buckets[bucket]
+
+    def match(self, endpoint, prompt):
+        # (similarity, earlier prompt, its answer) of the closest earlier
+        # prompt at or above the threshold, else None
+        signature = minhash(prompt)
+        with self.lock:
+            candidates = set()
+            for bucket in self.bands(endpoint, signature):
+                candidates |= self.buckets.get(bucket, set())
+            best = None
+            for key in candidates:
+                stored_at, earlier, answer, other, _ = self.entries[key]
+                if time.time() - stored_at >= self.ttl:
+                    self.drop(key)
+                    continue
+                score = sum(a == b for a, b in zip(signature, other)) / PERMUTATIONS
+                if score >= self.threshold and (best is None or score > best[0]):
+                    best = (score, earlier, answer, key)
+            if best is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best[3])
+            self.hits += 1
+            return best[:3]
+
+    def reuse(self):
+        # A matched answer was used instead of asking the backend
+        with self.lock:
+            self.reused += 1
+
+    def describe(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            rate = self.hits / lookups if lookups else 0.0
+            return (
+                f"Similar prompts: {len(self.entries)} entries ({self.bytes / 2**20:.1f} MiB), "
+                f"{self.hits} hits / {self.misses} misses ({rate:.0%}), {self.reused} reused, "
+                f"{self.evictions} evicted"
+            )
+
+
+class ResponseCache:
+    # Answers keyed on (endpoint, normalized query). Entries expire after
+    # ttl seconds; the memory tier keeps the max_entries most recently used,
+    # the optional SQLite tier the max_disk_entries most recently stored.
+    # With `similar`, stored answers are also indexed by SimilarPrompts.
+
+    def __init__(
+        self,
+        max_entries=CACHE_SIZE,
+        ttl=CACHE_TTL,
+        path=CACHE_FILE,
+        max_disk_entries=CACHE_DISK_SIZE,
+        similar=None,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.similar = similar
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.disk_hits = 0
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, answer TEXT NOT NULL, stored_at REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_by_age ON responses(stored_at)")
+
+    def key(self, endpoint, prompt):
+        return hashlib.sha256(f"{endpoint}\n{normalize_query(prompt)}".encode()).hexdigest()
+
+    def fresh(self, stored_at):
+        return time.time() - stored_at < self.ttl
+
+    def get(self, endpoint, prompt):
+        key = self.key(endpoint, prompt)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if self.fresh(entry[0]):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[key]
+            if self.conn is not None:
+                row = self.conn.execute("SELECT answer, stored_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and self.fresh(row[1]):
+                    answer = json.loads(row[0])
+                    self.remember(key, row[1], answer)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return answer
+            self.misses += 1
+            return None
+
+    def put(self, endpoint, prompt, answer):
+        key = self.key(endpoint, prompt)
+        stored_at = time.time()
+        with self.lock:
+            self.remember(key, stored_at, answer)
+            if self.conn is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, answer, stored_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(answer), stored_at),
+                )
+                self.conn.execute(
+                    "DELETE FROM responses WHERE stored_at < ? OR key IN "
+                    "(SELECT key FROM responses ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+                    (stored_at - self.ttl, self.max_disk_entries),
+                )
+        if self.similar is not None:
+            self.similar.add(endpoint, prompt, answer)
+
+    def match(self, endpoint, prompt):
+        # Answer to a near-duplicate of prompt, see SimilarPrompts.match
+        return self.similar.match(endpoint, prompt) if self.similar is not None else None
+
+    def remember(self, key, stored_at, answer):
+        self.entries[key] = (stored_at, answer)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def describe(self):
+        stats = self.stats()
+        text = (
+            f"Response cache: {stats['entries']} entries, {stats['hits']} hits / "
+            f"{stats['misses']} misses ({stats['hit_rate']:.0%})"
+        )
+        return text + ("\n\n" + self.similar.describe() if self.similar is not None else "")
+
+
+@st.cache_resource(show_spinner=False)
+def shared_cache():
+    return ResponseCache(similar=SimilarPrompts() if SIMILAR_MODE != "off" else None)
+
+
+def suggest_similar(prompt, url=QUERY_URL, raw_json=False):
+    # (similarity, earlier prompt, answer) to offer the operator before
+    # prompt is sent, when QUERY_SIMILAR=suggest; None otherwise
+    if SIMILAR_MODE != "suggest":
+        return None
+    return shared_cache().match(url + ("#raw" if raw_json else ""), prompt)
+
+
+class QueryStream:
+    # Iterable reply from the /query backend, meant for st.write_stream.
+    # Streams SSE, NDJSON or chunked text as it arrives and falls back to the
+    # plain JSON {"response": ...} contract. The full answer is available as
+    # .answer once the stream has been consumed. Successful answers go through
+    # the shared ResponseCache unless use_cache=False. serve_similar=False
+    # keeps QUERY_SIMILAR=serve from answering with a near-duplicate, for
+    # prompts that differ on purpose (templated batches, regeneration).
+
+    def __init__(
+        self,
+        prompt,
+        url=QUERY_URL,
+        raw_json=False,
+        error_prefix="Error contacting server",
+        client=None,
+        use_cache=True,
+        cache=None,
+        serve_similar=True,
+    ):
+        self.prompt = prompt
+        self.url = url
+        self.client = client or shared_client()
+        self.cache = (cache or shared_cache()) if use_cache else None
+        # Raw and unwrapped answers from the same endpoint must not mix
+        self.endpoint = url + ("#raw" if raw_json else "")
+        self.raw_json = raw_json
+        self.error_prefix = error_prefix
+        self.serve_similar = serve_similar
+        self.answer = None
+        self.cached = False
+        self.failed = False
+        # (similarity, earlier prompt, answer) when a near-duplicate was served
+        self.similar = None
+
+    def __iter__(self):
+        if self.cache is not None:
+            answer = self.cache.get(self.endpoint, self.prompt)
+            if answer is None and SIMILAR_MODE == "serve" and self.serve_similar:
+                self.similar = self.cache.match(self.endpoint, self.prompt)
+                if self.similar is not None:
+                    answer = self.similar[2]
+                    self.cache.similar.reuse()
+            if answer is not None:
+                self.answer = answer
+                self.cached = True
+                yield answer
+                return
+        # Identical questions already in flight are followed, not resent
+        flights = self.client.flights
+        parts = []
+        try:
+            with flights.join((self.endpoint, normalize_query(self.prompt)), self.fetch) as flight:
+                for token in flight.follow(flights.timeout):
+                    parts.append(token)
+                    yield token
+            error = flight.error
+        except Exception as e:
+            error = e
+        if error is None:
+            self.answer = flight.answer
+            return
+        self.failed = True
+        parts.append(("\n\n" if parts else "") + f"{self.error_prefix}: {error}")
+        yield parts[-1]
+        self.answer = "".join(parts)
+
+    def fetch(self, flight):
+        # The one backend request for this question, on a flight worker
+        with self.client.post(
+            self.url,
+            {"query": self.prompt, "stream": True},
+            headers={"Accept": STREAM_ACCEPT},
+            stream=True,
+        ) as res:
+            flight.res = res
+            if flight.cancelled:
+                return
+            # An error page is a failure, not an answer to show and cache
+            res.raise_for_status()
+            kind = res.headers.get("Content-Type", "").split(";")[0].strip()
+            if kind in ("", "application/json"):
+                data = res.json()
+                answer = data if self.raw_json else data.get("response", "No response from server.")
+                flight.publish(answer)
+                if self.cache is not None and (self.raw_json or "response" in data):
+                    self.cache.put(self.endpoint, self.prompt, answer)
+                flight.finish(answer)
+                return
+            parts = []
+            for token in iter_tokens(res, kind):
+                if token:
+                    parts.append(token)
+                    flight.publish(token)
+        # A cancelled stream can end early without an error
+        if flight.cancelled:
+            return
+        answer = "".join(parts)
+        if self.cache is not None and parts:
+            self.cache.put(self.endpoint, self.prompt, answer)
+        flight.finish(answer)
+
+
+class QueryDispatcher:
+    # Runs /query calls on a worker pool so the script thread never blocks.
+    # submit() writes a pending placeholder into the conversation right away;
+    # the worker previews partial tokens into it and stores the final answer
+    # when the backend is done. Placeholders are leased to this process
+    # while their worker runs, so other processes sharing the chat know
+    # they are still being computed.
+
+    def __init__(self, client, cache, max_workers=MAX_CONCURRENCY, batch_workers=BATCH_CONCURRENCY):
+        self.client = client
+        self.cache = cache
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query")
+        # Separate queue so a long batch never delays interactive questions
+        self.batch_pool = ThreadPoolExecutor(max_workers=batch_workers, thread_name_prefix="batch")
+        # job id -> store of the placeholder
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        threading.Thread(target=self.renew, daemon=True, name="query-leases").start()
+
+    def submit(self, store, cid, prompt, after=None, url=QUERY_URL, **kwargs):
+        # The placeholder goes after message id `after`, or at the end
+        job = uuid4().hex
+        # Register and lease before the placeholder is visible so pollers,
+        # here or in another process, never see an orphan
+        with self.lock:
+            self.jobs[job] = store
+        placeholder = {"role": "assistant", "content": PENDING_TEXT, "pending": job}
+        try:
+            store.lease_pending(self.owner, [job])
+            if after is None:
+                store.append_message(cid, placeholder)
+            else:
+                store.insert_after(cid, after, placeholder)
+            self.pool.submit(self.run, store, cid, placeholder["id"], job, prompt, url, kwargs)
+        except Exception:
+            self.finish(job)
+            raise
+        return job
+
+    def run(self, store, cid, mid, job, prompt, url, kwargs):
+        try:
+            reply = QueryStream(prompt, url=url, client=self.client, cache=self.cache, **kwargs)
+            partial = ""
+            last_preview = time.monotonic()
+            for token in reply:
+                if isinstance(token, str):
+                    partial += token
+                if time.monotonic() - last_preview >= PREVIEW_INTERVAL:
+                    store.preview_pending(cid, mid, job, partial)
+                    last_preview = time.monotonic()
+            store.resolve_pending(cid, mid, job, reply.answer)
+        finally:
+            self.finish(job)
+
+    def regenerate(self, store, cids, url=QUERY_URL, use_cache=False, **kwargs):
+        # Re-ask every user prompt of the given chats; returns the Batch
+        prompts = [
+            (cid, msg["id"], msg["content"])
+            for cid in cids
+            for msg in store.messages(cid)
+            if msg["role"] == "user" and isinstance(msg["content"], str)
+        ]
+        batch = Batch(store, prompts)
+        for task in prompts:
+            self.batch_pool.submit(self.ask, batch, task, url, dict(kwargs, use_cache=use_cache, serve_similar=False))
+        return batch
+
+    def ask(self, batch, task, url, kwargs):
+        reply = None
+        try:
+            reply = QueryStream(task[2], url=url, client=self.client, cache=self.cache, **kwargs)
+            for _ in reply:
+                pass
+        finally:
+            batch.record(task, reply)
+
+    def renew(self):
+        while True:
+            time.sleep(LEASE_HEARTBEAT)
+            with self.lock:
+                stores = {}
+                for job, store in self.jobs.items():
+                    stores.setdefault(store, []).append(job)
+            for store, jobs in stores.items():
+                try:
+                    store.lease_pending(self.owner, jobs)
+                except Exception:
+                    # e.g. the database is locked for longer than its timeout
+                    pass
+
+    def finish(self, job):
+        with self.lock:
+            self.jobs.pop(job, None)
+
+    def in_flight(self, job):
+        with self.lock:
+            return job in self.jobs
+
+
+class Batch:
+    # Progress of one "regenerate all" run. Answers are collected in memory
+    # and written by the last reply in a single store transaction; failed
+    # queries keep their old answer.
+
+    def __init__(self, store, prompts):
+        self.store = store
+        self.total = len(prompts)
+        self.done = 0
+        self.failed = 0
+        self.answers = {}
+        self.error = None
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        if not prompts:
+            self.finished.set()
+
+    def record(self, task, reply):
+        cid, mid, _ = task
+        with self.lock:
+            self.done += 1
+            if reply is None or reply.failed or reply.answer is None:
+                self.failed += 1
+            else:
+                self.answers.setdefault(cid, []).append((mid, reply.answer))
+            last = self.done == self.total
+        if last:
+            try:
+                self.store.replace_answers(self.answers)
+            except Exception as e:
+                self.error = str(e)
+            finally:
+                self.finished.set()
+
+    def describe(self):
+        if not self.finished.is_set():
+            return f"Regenerating answers: {self.done}/{self.total}"
+        if self.error:
+            return f"Regeneration failed: {self.error}"
+        return f"Regenerated {self.total - self.failed} answers ({self.failed} failed)"
+
+
+@st.cache_resource(show_spinner=False)
+def shared_dispatcher():
+    return QueryDispatcher(shared_client(), shared_cache())
+
+
+def dispatch_query(store, cid, prompt, after=None, **kwargs):
+    return shared_dispatcher().submit(store, cid, prompt, after=after, **kwargs)
+
+
+def poll_pending(store, cid):
+    # True while a reply for this chat is still being computed. Placeholders
+    # whose worker is gone (e.g. the server restarted) are closed out, unless
+    # they belong to a durable job that is still queued or running, or
+    # another process holds a live lease on them.
+    dispatcher = shared_dispatcher()
+    pending = store.pending_jobs(cid)
+    orphans = [(mid, job) for mid, job in pending if not dispatcher.in_flight(job)]
+    jobs = [job for _, job in orphans]
+    alive = store.active_jobs(jobs) | store.leased_jobs(jobs, dispatcher.owner, LEASE)
+    for mid, job in orphans:
+        if job not in alive:
+            store.resolve_pending(cid, mid, job, INTERRUPTED_TEXT, failed=True)
+    return len(orphans) < len(pending) or bool(alive)
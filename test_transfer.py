@@ -0,0 +1,41 @@
+import io
+import json
+import pickle
+
+from chat_store import HISTORY_CHAT, ChatStore
+from transfer import export_jsonl, import_jsonl
+
+
+def jsonl(*records):
+    return io.BytesIO("".join(json.dumps(record) + "\n" for record in records).encode())
+
+
+def test_import_into_chat_migrated_from_pickle(tmp_path):
+    # X.py's pickle is a flat message list; its chat gets no dates
+    with open(tmp_path / "chat_history.pkl", "wb") as f:
+        pickle.dump([{"role": "user", "content": "old question"}], f)
+    store = ChatStore(str(tmp_path / "chat_history.db"))
+    assert store.chats[HISTORY_CHAT]["updated_at"] is None
+
+    read, added = import_jsonl(
+        store, jsonl({"id": "m1", "role": "user", "content": "imported"}), "x", chat_id=HISTORY_CHAT
+    )
+
+    assert (read, added) == (1, 1)
+    assert [msg["content"] for msg in store.messages(HISTORY_CHAT)] == ["old question", "imported"]
+    assert store.chats[HISTORY_CHAT]["updated_at"] is not None
+
+
+def test_round_trip_is_idempotent(tmp_path):
+    source = ChatStore(str(tmp_path / "a.db"), legacy_file="")
+    cid = source.create_chat("RAN")
+    source.append_message(cid, {"role": "user", "content": "q"})
+    source.append_message(cid, {"role": "assistant", "content": {"cfg": 1}})
+    out = io.StringIO()
+    assert export_jsonl(source, out) == 2
+
+    target = ChatStore(str(tmp_path / "b.db"), legacy_file="")
+    data = out.getvalue().encode()
+    assert import_jsonl(target, io.BytesIO(data), "x") == (2, 2)
+    assert import_jsonl(target, io.BytesIO(data), "x") == (2, 0)
+    assert [msg["content"] for msg in target.messages(cid)] == ["q", {"cfg": 1}]
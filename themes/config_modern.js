@@ -0,0 +1,24 @@
+// Remove the "Deploy" button if it still exists
+setTimeout(() => {
+    const deployButton = document.querySelector('.stDeployButton');
+    if (deployButton) deployButton.style.display = 'none';
+}, 100);
+
+window.addEventListener('message', function(event) {
+    if (event.data.type === 'editMsg') {
+        Streamlit.setComponentValue({edit_msg_id: event.data.id});
+    }
+    if (event.data.type === 'sampleQuery') {
+        Streamlit.setComponentValue({sample_query: event.data.query});
+    }
+});
+
+// Focus the input box when clicking sample queries
+document.querySelectorAll('.query-card').forEach(card => {
+    card.addEventListener('click', function() {
+        setTimeout(() => {
+            const input = document.querySelector('[data-testid="stChatInput"] textarea');
+            if (input) input.focus();
+        }, 100);
+    });
+});
@@ -0,0 +1,155 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+
+from chat_store import ChatStore
+
+# Streaming JSONL export/import of conversations, one record per message:
+#
+#   python transfer.py export conversations.db history.jsonl --name RAN --since 2026-01-01
+#   python transfer.py import conversations.db history.jsonl
+#   python transfer.py import conversations.db requests.jsonl --into Backlog
+#
+# A record is {"chat_id", "chat_name", "chat_created_at", "chat_updated_at",
+# "id", "role", "content", "timestamp"}. Both directions hold one message
+# (export) or one batch (import) in memory at a time. Import skips message
+# ids already in the store and saves its file offset with every batch, so
+# an interrupted import resumes where it stopped and a repeated one adds
+# nothing. Records without chat fields go to the --into conversation;
+# {"request_id", "title", "body"} lines (requests.jsonl) become user
+# messages. Legacy pickles are converted with migrate.py first.
+
+# Messages written per transaction
+IMPORT_BATCH = 1000
+
+
+def matches(name, created_at, updated_at, since=None, until=None, pattern=None):
+    # Chat filter shared by export and import: chats active between since
+    # and until ("YYYY-MM-DD[ HH:MM]", inclusive) whose name contains pattern
+    if pattern and pattern.casefold() not in (name or "").casefold():
+        return False
+    if since and updated_at and updated_at < since:
+        return False
+    if until and created_at and created_at[:len(until)] > until:
+        return False
+    return True
+
+
+def export_jsonl(store, f, since=None, until=None, pattern=None):
+    # Writes the matching chats to text file f; returns the message count
+    cids = [
+        cid
+        for cid, chat in list(store.chats.items())
+        if matches(chat["name"], chat["created_at"], chat["updated_at"], since, until, pattern)
+    ]
+    count = 0
+    for record in store.export_records(cids):
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def to_record(data, chat_name):
+    # Store record for one JSONL line; missing ids are derived from the
+    # line itself so that importing it again finds the same message
+    if "request_id" in data and "content" not in data:
+        text = f"{data.get('title', '')}\n\n{data.get('body', '')}".strip()
+        data = {"id": data["request_id"], "role": "user", "content": text}
+    name = data.get("chat_name") or chat_name
+    record = {
+        "chat_id": data.get("chat_id") or str(uuid.uuid5(uuid.NAMESPACE_URL, f"jsonl-import:{name}")),
+        "chat_name": name,
+        "chat_created_at": data.get("chat_created_at"),
+        "chat_updated_at": data.get("chat_updated_at"),
+        "role": data.get("role", "user"),
+        "content": data.get("content"),
+        "timestamp": data.get("timestamp"),
+    }
+    record["id"] = data.get("id") or hashlib.sha256(json.dumps(record, sort_keys=True).encode()).hexdigest()[:32]
+    return record
+
+
+def import_jsonl(
+    store, f, chat_name, since=None, until=None, pattern=None, resume_key=None, progress=None, chat_id=None
+):
+    # Reads binary file f line by line into the store, IMPORT_BATCH
+    # messages per transaction. With resume_key, starts from the offset the
+    # last run on the same key got to; with chat_id, every message goes into
+    # that chat. Returns (read, added) message counts.
+    offset = int(store.meta(resume_key) or 0) if resume_key else 0
+    if offset:
+        f.seek(offset)
+    read = added = 0
+    batch = []
+    for line in f:
+        offset += len(line)
+        if not line.strip():
+            continue
+        record = to_record(json.loads(line), chat_name)
+        read += 1
+        if chat_id is not None:
+            record["chat_id"] = chat_id
+        if record["content"] is None or not matches(
+            record["chat_name"], record["chat_created_at"], record["chat_updated_at"], since, until, pattern
+        ):
+            continue
+        batch.append(record)
+        if len(batch) >= IMPORT_BATCH:
+            added += store.import_records(batch, (resume_key, str(offset)) if resume_key else None)
+            batch = []
+            if progress is not None:
+                progress(offset, read, added)
+    added += store.import_records(batch, (resume_key, str(offset)) if resume_key else None)
+    return read, added
+
+
+def resume_key(path):
+    # Same file, same size and mtime: pick up where the last run stopped
+    stat = os.stat(path)
+    return f"jsonl_import:{os.path.abspath(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export or import conversations as JSONL, one message per line")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("db", help="conversation database, e.g. conversations.db or chat_history.db")
+    parser.add_argument("path", help="JSONL file to write or read; - for stdout/stdin")
+    parser.add_argument("--name", help="only chats whose name contains this")
+    parser.add_argument("--since", help="only chats active on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--until", help="only chats created on or before this date (YYYY-MM-DD)")
+    parser.add_argument("--into", help="import: chat for records without one (default: the file name)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    store = ChatStore(args.db, legacy_file="")
+    if args.action == "export":
+        if args.path == "-":
+            count = export_jsonl(store, sys.stdout, args.since, args.until, args.name)
+        else:
+            with open(args.path, "w", encoding="utf-8") as f:
+                count = export_jsonl(store, f, args.since, args.until, args.name)
+        print(f"Exported {count} messages in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        return 0
+
+    chat_name = args.into or ("Import" if args.path == "-" else os.path.splitext(os.path.basename(args.path))[0])
+    filters = (args.since, args.until, args.name)
+
+    def progress(offset, read, added):
+        print(f"\r{read} read, {added} added, {offset / 2**20:.1f} MiB", end="", file=sys.stderr)
+
+    if args.path == "-":
+        # A pipe cannot seek, so there is nothing to resume
+        read, added = import_jsonl(store, sys.stdin.buffer, chat_name, *filters, progress=progress)
+    else:
+        with open(args.path, "rb") as f:
+            read, added = import_jsonl(store, f, chat_name, *filters, resume_key(args.path), progress)
+    print(f"\rImported {added} of {read} messages in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())